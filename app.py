@@ -1,4 +1,5 @@
 # nuitka-project: --onefile
+# nuitka-project: --onefile-tempdir-spec={CACHE_DIR}/WirthMage/{VERSION}
 # nuitka-project: --output-filename=WirthMage.exe
 # nuitka-project: --windows-console-mode=disable
 # nuitka-project: --windows-icon-from-ico=assets/icon.ico
@@ -13,8 +14,13 @@
 
 from __future__ import annotations
 
+# 以降の import を計測できるよう最初に読み込む
+import startup_profile
+
 import os
+import sys
 import threading
+import time
 from collections.abc import Iterable
 from pathlib import Path
 from typing import List
@@ -22,9 +28,10 @@ from typing import List
 import wx
 
 import constants as cs
-from converter import convert
 from converter_params import ConverterParams
 
+startup_profile.mark("import")
+
 
 class App(wx.App):
     input_dir = cs.INPUT_PATH
@@ -34,11 +41,16 @@ class App(wx.App):
 
         import ui  # The wx.App object must be created first!
 
+        startup_profile.mark("import ui")
+
         view = self.view = ui.MainFrame()
+        startup_profile.mark("build frame")
+
         model = self.model = ConverterParams()
 
         if cs.CONFIG_JSON.is_file():
             model.load(cs.CONFIG_JSON)
+        startup_profile.mark("load config")
 
         view.panel.SetDropTarget(self.FileDropTarget(self))
 
@@ -52,6 +64,8 @@ class App(wx.App):
         block.text.SetLabel(str(model.output_dir))
         block.change_button.Bind(ui.EVT_CLICKED, self.change_output_dir)
         block.open_button.Bind(ui.EVT_CLICKED, self.show_output_dir)
+        block.zip_checkbox.SetValue(self.output_zip)
+        block.zip_checkbox.Bind(ui.EVT_CLICKED, self.on_change_output_zip)
 
         block = view.output_size
         block.switch.SetValue(model.image_size)
@@ -70,6 +84,27 @@ class App(wx.App):
         block.outline_style_choice.SetSelection(
             tuple(cs.OutlineStyle).index(model.outline_style)
         )
+        if model.outline_width in cs.OUTLINE_WIDTHS:
+            block.outline_width_choice.SetSelection(
+                cs.OUTLINE_WIDTHS.index(model.outline_width)
+            )
+        block.dither_method_choice.SetSelection(
+            tuple(cs.DitherMethod).index(model.dither_method)
+        )
+        block.animation_mode_choice.SetSelection(
+            tuple(cs.AnimationMode).index(model.animation_mode)
+        )
+        block.quality_choice.SetSelection(
+            tuple(cs.Quality).index(model.quality)
+        )
+        # config.json で選択肢にない上限を指定していればそれも選べるようにする
+        self.jpeg_max_sizes = sorted({*cs.JPEG_MAX_SIZES, model.jpeg_max_size})
+        block.jpeg_max_size_choice.SetItems(
+            [cs.jpeg_max_size_label(x) for x in self.jpeg_max_sizes]
+        )
+        block.jpeg_max_size_choice.SetSelection(
+            self.jpeg_max_sizes.index(model.jpeg_max_size)
+        )
         for control in block.controls:
             control.Bind(ui.EVT_CLICKED, self.on_change_output_format)
             control.Bind(wx.EVT_CHOICE, self.on_change_output_format)
@@ -80,6 +115,7 @@ class App(wx.App):
         self.view.Bind(wx.EVT_CLOSE, self.quit)
 
         self.view.Bind(wx.EVT_ACTIVATE, self.refresh)
+        startup_profile.mark("bind")
 
     def refresh(self, *_) -> None:
         for control in (
@@ -112,11 +148,35 @@ class App(wx.App):
         self.model.outline_style = tuple(cs.OutlineStyle)[
             block.outline_style_choice.GetSelection()
         ]
+        self.model.outline_width = cs.OUTLINE_WIDTHS[
+            block.outline_width_choice.GetSelection()
+        ]
+        self.model.dither_method = tuple(cs.DitherMethod)[
+            block.dither_method_choice.GetSelection()
+        ]
+        self.model.animation_mode = tuple(cs.AnimationMode)[
+            block.animation_mode_choice.GetSelection()
+        ]
+        self.model.quality = tuple(cs.Quality)[
+            block.quality_choice.GetSelection()
+        ]
+        self.model.jpeg_max_size = self.jpeg_max_sizes[
+            block.jpeg_max_size_choice.GetSelection()
+        ]
+        block.jpeg_max_size_choice.Enable(
+            self.model.image_type == cs.ImageType.JPEG
+        )
         flag = self.model.image_type != cs.ImageType.JPEG
         block.color_mask_checkbox.Enable(flag)
         block.indexed_color_choice.Enable(flag)
+        block.dither_method_choice.Enable(
+            flag and self.model.indexed_color != cs.IndexedColor.NONE
+        )
         flag = flag and self.model.color_mask
         block.outline_style_choice.Enable(flag)
+        block.outline_width_choice.Enable(
+            flag and self.model.outline_style != cs.OutlineStyle.NONE
+        )
         self.refresh()
 
     def add_input_files(self, *_) -> None:
@@ -133,11 +193,15 @@ class App(wx.App):
         self.refresh()
 
     def _add_input_files(self, paths: Iterable[str | Path]) -> None:
+        # zipfile を読み込むので起動時には読み込まない
+        import sources
+
         data = self.model.input_files
         listbox = self.view.input_files.listbox
         for path in paths:
             path = Path(path).absolute()
-            data[path.name] = path
+            for item in sources.iter_inputs(path):
+                data[item.name] = item
         listbox.SetItems(sorted(data.keys()))
         self.input_dir = path.parent
         self.refresh()
@@ -156,21 +220,56 @@ class App(wx.App):
         self.view.input_files.listbox.SetItems(())
         self.refresh()
 
+    @property
+    def output_zip(self) -> bool:
+        return self.model.output_dir.suffix.lower() in cs.ARCHIVE_SUFFIXES
+
+    def set_output_dir(self, path: str | Path) -> None:
+        self.model.output_dir = path
+        self.view.output_dir.text.SetLabel(str(self.model.output_dir))
+
+    def on_change_output_zip(self, *_) -> None:
+        # 同じ名前のフォルダと書庫を切り替える
+        path = self.model.output_dir
+        if self.view.output_dir.zip_checkbox.GetValue():
+            if not self.output_zip:
+                self.set_output_dir(path.with_name(f"{path.name}.zip"))
+        elif self.output_zip:
+            self.set_output_dir(path.with_suffix(""))
+        self.refresh()
+
     def change_output_dir(self, *_) -> None:
-        with wx.DirDialog(
-            self.view,
-            message=cs.FOLDER_DIALOG_TITLE,
-            style=wx.DD_DEFAULT_STYLE | wx.DD_DIR_MUST_EXIST,
-            defaultPath=str(self.model.output_dir),
-        ) as dialog:
+        if self.output_zip:
+            # 既存の書庫を選んだ場合は今回出力しないエントリを引き継ぐ
+            dialog = wx.FileDialog(
+                self.view,
+                message=cs.ARCHIVE_DIALOG_TITLE,
+                style=wx.FD_SAVE,
+                wildcard="|".join("|".join(x) for x in cs.ARCHIVE_TYPES),
+                defaultDir=str(self.model.output_dir.parent),
+                defaultFile=self.model.output_dir.name,
+            )
+        else:
+            dialog = wx.DirDialog(
+                self.view,
+                message=cs.FOLDER_DIALOG_TITLE,
+                style=wx.DD_DEFAULT_STYLE | wx.DD_DIR_MUST_EXIST,
+                defaultPath=str(self.model.output_dir),
+            )
+        with dialog:
             if dialog.ShowModal() == wx.ID_OK:
-                path = dialog.GetPath()
-                self.model.output_dir = path
-                self.view.output_dir.text.SetLabel(path)
+                path = Path(dialog.GetPath())
+                if self.output_zip and path.suffix.lower() != ".zip":
+                    path = path.with_name(f"{path.name}.zip")
+                self.set_output_dir(path)
         self.refresh()
 
     def show_output_dir(self, *_) -> None:
-        os.startfile(self.model.output_dir)
+        # 書庫がまだなければ置き場所のフォルダを開く
+        path = self.model.output_dir
+        if self.output_zip and not path.is_file():
+            path = path.parent
+        os.startfile(path)
         self.refresh()
 
     def execute(self, *_) -> None:
@@ -185,24 +284,35 @@ class App(wx.App):
         progress_view = ui.ProgressDialog(self.view, progress_model)
 
         def worker() -> None:
+            # 変換処理のモジュールは起動を速くするため実行時に読み込む
+            from batch import run_batch
+
             listbox = self.view.input_files.listbox
             data = self.model.input_files
-            paths = tuple(data.values())
-            params = {**vars(self.model)}
-            del params["input_files"]
-
-            for path in paths:
-                if progress_view.model.is_cancelled:
-                    break
-
-                if (path := Path(path)).is_file():
-                    try:
-                        convert(path, **params)
-                    except FileNotFoundError:
-                        del data[path.name]
-                        wx.CallAfter(listbox.SetItems, sorted(data.keys()))
-                    finally:
-                        wx.CallAfter(progress_view.advance)
+
+            def on_done(path: Path, error: Exception | None) -> None:
+                if isinstance(error, FileNotFoundError):
+                    data.pop(path.name, None)
+                    wx.CallAfter(listbox.SetItems, sorted(data.keys()))
+                wx.CallAfter(progress_view.advance)
+
+            report, report_path = run_batch(
+                tuple(data.values()),
+                self.model,
+                on_done=on_done,
+                # キャンセルされたら残りのファイルは変換しない
+                is_cancelled=lambda: progress_view.model.is_cancelled,
+            )
+
+            if report_path:
+                wx.CallAfter(
+                    wx.MessageBox,
+                    cs.FAILURE_MESSAGE.format(
+                        count=len(report), path=report_path
+                    ),
+                    cs.APP_NAME,
+                    wx.OK | wx.ICON_WARNING,
+                )
 
             wx.CallAfter(self.refresh)
 
@@ -214,23 +324,56 @@ class App(wx.App):
         self.view.Destroy()
 
     def Mainloop(self) -> None:
-        self.watch_input_files()
         self.view.Show()
+        wx.CallAfter(self.on_shown)
         super().MainLoop()
 
-    def watch_input_files(self) -> None:
-        data = self.model.input_files
-        deleted = False
+    def on_shown(self) -> None:
+        # ウィンドウを表示してから後回しにできる準備をする
+        startup_profile.mark("show")
 
-        for key, path in data.items():
-            if not path.is_file():
-                del data[key]
-                deleted = True
+        from thumbnails import ThumbnailCache
+
+        listbox = self.view.input_files.listbox
+        listbox.SetThumbnails(
+            ThumbnailCache(cs.THUMBNAIL_PATH, listbox.thumbnail_size),
+            lambda name: self.model.input_files.get(name),
+        )
+        startup_profile.mark("thumbnails")
+
+        # ImageMagick の機能の確認は初回の変換を待たせないよう裏で済ませる
+        import capabilities
 
-        if deleted:
-            self.view.input_files.listbox.SetItems(sorted(data.keys()))
+        threading.Thread(target=capabilities.current, daemon=True).start()
+        threading.Thread(target=self.watch_input_files, daemon=True).start()
+        startup_profile.finish(cs.ROOT_PATH / "startup-profile.txt")
 
-        wx.CallLater(100, self.watch_input_files)
+    def watch_input_files(self) -> None:
+        # 消された入力ファイルを一覧から外す
+        # ネットワーク上のファイルや書庫内のエントリも調べるので
+        # UI スレッドではなく別スレッドで間隔を空けて確かめる
+        import sources
+
+        while True:
+            time.sleep(1)
+            missing = [
+                (key, path)
+                for key, path in tuple(self.model.input_files.items())
+                if not sources.exists(path)
+            ]
+            if missing:
+                wx.CallAfter(self._remove_input_files, missing)
+
+    def _remove_input_files(self, items: Iterable[tuple[str, Path]]) -> None:
+        if not self.view:
+            return
+
+        data = self.model.input_files
+        for key, path in items:
+            # 確かめている間に追加し直されたものは残す
+            if data.get(key) == path:
+                del data[key]
+        self.view.input_files.listbox.SetItems(sorted(data.keys()))
 
     class FileDropTarget(wx.FileDropTarget):
 
@@ -239,11 +382,11 @@ class App(wx.App):
             self.app = app
 
         def OnDropFiles(self, x: int, y: int, filenames: List[str]) -> bool:
+            suffixes = (*cs.IMAGE_SUFFIXES, *cs.ARCHIVE_SUFFIXES)
             filenames = [
                 filename
                 for filename in filenames
-                if Path(filename).suffix.lower()
-                in (".bmp", ".png", ".jpg", ".jpeg", ".gif")
+                if Path(filename).suffix.lower() in suffixes
             ]
             if filenames:
                 self.app._add_input_files(filenames)
@@ -253,4 +396,21 @@ class App(wx.App):
 
 
 if __name__ == "__main__":
-    App().Mainloop()
+    if sys.argv[1:2] == ["--serve"]:
+        import server
+
+        server.main(sys.argv[2:])
+    elif sys.argv[1:2] == ["--watch"]:
+        import hotfolder
+
+        hotfolder.main(sys.argv[2:])
+    elif sys.argv[1:2] == ["--palettes"]:
+        import palettes
+
+        palettes.main(sys.argv[2:])
+    elif sys.argv[1:2] == ["--queue"]:
+        import workqueue
+
+        workqueue.main(sys.argv[2:])
+    else:
+        App().Mainloop()
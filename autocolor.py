@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import bisect
+import math
+import struct
+import zlib
+from collections import Counter
+from collections.abc import Generator
+from functools import partial
+
+# 減色の「自動」で、量子化誤差が目標以下になる最小の色数を探す
+#
+# 読み込み・リサイズ・縮小・事前減色を済ませた標本を一度だけ作り、
+# 候補の色数ごとの k-means はその小さな標本に対して行う。
+# 誤差は標本の色ごとの画素数 (ヒストグラム) から Python で求めるので、
+# 色数を試すたびに元画像を読み直したり比較用の画像を作ったりしない。
+
+# 候補の色数 (2のべき乗)
+LEVELS = tuple(1 << i for i in range(1, 9))
+
+Histogram = Counter[bytes]
+
+
+def read_pam(data: bytes) -> tuple[int, bytes]:
+    # magick が出力した PAM (-depth 8) のチャンネル数と画素列
+    header_end = data.index(b"ENDHDR\n") + len(b"ENDHDR\n")
+    fields = dict(
+        line.split(None, 1)
+        for line in data[:header_end].decode("ascii").splitlines()[1:-1]
+        if line and not line.startswith("#")
+    )
+    depth = int(fields["DEPTH"])
+    if int(fields["MAXVAL"]) != 255:
+        raise ValueError("PAM must be 8-bit")
+    return depth, data[header_end:]
+
+
+def histogram(data: bytes) -> tuple[int, Histogram]:
+    depth, pixels = read_pam(data)
+    return depth, Counter(
+        pixels[i : i + depth] for i in range(0, len(pixels), depth)
+    )
+
+
+def palette_colors(data: bytes) -> tuple[int, list[bytes]]:
+    depth, pixels = read_pam(data)
+    return depth, [pixels[i : i + depth] for i in range(0, len(pixels), depth)]
+
+
+def error(histogram: Histogram, palette: list[bytes]) -> float:
+    # 各画素を最も近いパレット色に置き換えたときの距離の二乗平均平方根
+    # (0〜255 のチャンネル値のユークリッド距離、ディザなし)
+    total = 0
+    count = 0
+
+    for color, n in histogram.items():
+        total += n * min(map(partial(math.dist, color), palette)) ** 2
+        count += n
+
+    return math.sqrt(total / count) if count else 0.0
+
+
+def encode_png(depth: int, palette: list[bytes]) -> bytes:
+    # -remap に渡す 1 行のパレット画像 (グレー・RGB と各アルファ付き)
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[depth]
+    raw = b"\0" + b"".join(palette)
+
+    def chunk(kind: bytes, body: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(body))
+            + kind
+            + body
+            + struct.pack(">I", zlib.crc32(kind + body))
+        )
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(
+            b"IHDR",
+            struct.pack(">IIBBBBB", len(palette), 1, 8, color_type, 0, 0, 0),
+        )
+        + chunk(b"IDAT", zlib.compress(raw))
+        + chunk(b"IEND", b"")
+    )
+
+
+def search(
+    target: float,
+    hint: int | None = None,
+) -> Generator[int, float, int]:
+    # 試す色数を yield し、その誤差を send で受け取る二分探索
+    # 誤差は色数に対して単調に減るものとし、256色で目標に届かなくても
+    # 256色を返す
+    lo, hi = 0, len(LEVELS) - 1
+
+    if hint is None:
+        i = (lo + hi) // 2
+    else:
+        # 別の倍率で選んだ色数と同じになることが多いので、
+        # まずその色数と隣を確かめてから残りを二分探索する
+        i = min(bisect.bisect_left(LEVELS, hint), hi)
+
+    while lo < hi:
+        if (yield LEVELS[i]) <= target:
+            hi = i
+        else:
+            lo = i + 1
+
+        if hint is not None:
+            i = max(lo, hi - 1) if hi == i else lo
+            hint = None
+        else:
+            i = (lo + hi) // 2
+
+    return LEVELS[hi]
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import metrics
+import sources
+from converter import QUEUE_DEPTH, FallbackWarning, convert
+from converter_params import ConverterParams
+from journal import BatchJournal
+from report import FailureReport
+from scheduler import (
+    MemoryBudget,
+    apply_budget,
+    default_workers,
+    estimate_memory,
+    order_by_cost,
+    thread_limit,
+)
+from sinks import open_sink
+
+# GUI と常駐モードで共通のバッチ変換
+# 重いファイルから順に、推定メモリの合計が予算に収まる範囲で並列に変換し、
+# 失敗したファイルは報告に回して残りの変換を続ける
+
+
+def run_batch(
+    paths: Iterable[Path],
+    params: ConverterParams,
+    workers: int = 0,
+    on_done: Callable[[Path, Exception | None], None] | None = None,
+    is_cancelled: Callable[[], bool] = lambda: False,
+) -> tuple[FailureReport, Path | None]:
+    # on_done(入力のパス, 例外) は変換を終えたファイルごとに
+    # ワーカスレッドから呼ぶ (キャンセルで飛ばしたものは呼ばない)
+    # 戻り値は失敗の報告とその書き出し先 (失敗がなければ None)
+    paths = tuple(paths)
+    output_dir = params.output_dir
+    # JPEG の出力サイズの予算はバッチごとに割り振る
+    options = apply_budget(paths, params.options(), params.jpeg_budget)
+    limits = params.job_limits()
+    journal = BatchJournal(output_dir, options)
+    budget = MemoryBudget(params.memory_budget << 20)
+    report = FailureReport()
+    workers = workers or default_workers()
+    threads = thread_limit(workers)
+
+    def run(path: Path) -> None:
+        if is_cancelled():
+            # 残りは変換せず、待ちの件数だけ減らす
+            QUEUE_DEPTH.dec()
+            return
+
+        error = None
+        try:
+            if sources.exists(path) and not journal.is_done(path):
+                memory = estimate_memory(path, options)
+                with budget.reserve(memory) as limit:
+                    outputs = convert(
+                        path,
+                        sink,
+                        memory_limit=limit,
+                        thread_limit=threads,
+                        palette_cache=True,
+                        **limits,
+                        **options,
+                    )
+                journal.record(path, outputs)
+        except FileNotFoundError as e:
+            # 途中で消されたファイルは失敗として扱わない
+            error = e
+        except FallbackWarning as e:
+            # 軽い設定で出力できた分も報告に載せ、次回は選んだ設定で
+            # 変換し直すよう記録には残さない
+            report.add(path, e)
+            error = e
+        except Exception as e:
+            report.add(path, e)
+            error = e
+        finally:
+            QUEUE_DEPTH.dec()
+
+        if on_done is not None:
+            on_done(path, error)
+
+    with (
+        open_sink(output_dir) as sink,
+        ThreadPoolExecutor(workers) as executor,
+    ):
+        QUEUE_DEPTH.inc(len(paths))
+        for path in order_by_cost(paths, options):
+            executor.submit(run, path)
+
+    sources.close_archives()
+
+    if params.metrics_file:
+        metrics.write(params.metrics_file)
+
+    return report, report.save(output_dir)
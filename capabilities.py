@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import subprocess
+import threading
+from pathlib import Path
+from typing import NamedTuple
+
+import launcher
+from constants import CAPABILITIES_JSON
+
+# -kmeans が使えるようになったバージョン
+KMEANS_VERSION = (7, 0, 10, 37)
+
+
+# 使用する ImageMagick の機能や既定の制限
+# 実行ファイルのサイズ・更新日時と -version の出力をキーにしてキャッシュし、
+# どちらかが変わったときだけ調べ直す (Linux などでは実行ファイルが
+# そのままでもライブラリの更新でバージョンや機能が変わる)
+class Capabilities(NamedTuple):
+    version: str = ""
+    quantum_depth: int = 16
+    hdri: bool = True
+    openmp: bool = True
+    # 1プロセスが使うスレッド数の上限 (0 なら不明)
+    threads: int = 0
+    # 形式ごとの読み書きの可否 (空なら不明)
+    formats: dict[str, str] = {}
+
+    @property
+    def version_info(self) -> tuple[int, ...]:
+        return tuple(int(x) for x in re.findall(r"\d+", self.version)[:4])
+
+    @property
+    def bytes_per_pixel(self) -> int:
+        # 1画素 RGBA (HDRI なら float32、それ以外は量子化深度)
+        return 4 * (4 if self.hdri else self.quantum_depth // 8)
+
+    @property
+    def kmeans(self) -> bool:
+        # バージョンが分からない場合は使えるものとする
+        return not self.version or self.version_info >= KMEANS_VERSION
+
+    def can_write(self, name: str) -> bool:
+        return not self.formats or "w" in self.formats.get(name.upper(), "")
+
+
+_current: Capabilities | None = None
+_lock = threading.Lock()
+
+
+def current() -> Capabilities:
+    # 初回だけキャッシュを読むか調べ、以降はプロセス内で使い回す
+    global _current
+
+    with _lock:
+        if _current is None:
+            _current = load(launcher.locate())
+        return _current
+
+
+def load(binary: Path) -> Capabilities:
+    if (stamp := _stamp(binary)) is None:
+        return Capabilities()
+
+    # -version は1回だけ起動すれば済むので毎回確かめる
+    if (version := _run("-version")) is None:
+        return Capabilities()
+
+    text = "\0".join(map(str, (binary, *stamp, version)))
+    key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    try:
+        cache = json.loads(CAPABILITIES_JSON.read_text(encoding="utf-8"))
+        if cache["key"] == key:
+            return Capabilities(**cache["capabilities"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    if (capabilities := probe(version)) is None:
+        return Capabilities()
+
+    try:
+        CAPABILITIES_JSON.parent.mkdir(parents=True, exist_ok=True)
+        CAPABILITIES_JSON.write_text(
+            json.dumps(
+                {"key": key, "capabilities": capabilities._asdict()},
+                indent=4,
+            ),
+            encoding="utf-8",
+        )
+    except OSError:
+        pass
+
+    return capabilities
+
+
+def probe(version: str) -> Capabilities | None:
+    resource = _run("-list", "resource")
+    formats = _run("-list", "format")
+
+    if resource is None or formats is None:
+        return None
+
+    return Capabilities(
+        **parse_version(version),
+        threads=parse_resource(resource).get("thread", 0),
+        formats=parse_formats(formats),
+    )
+
+
+def _run(*params: str) -> str | None:
+    from converter import magick
+
+    try:
+        result = magick(*params, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+    if result.returncode != 0:
+        return None
+
+    return result.stdout.decode("utf-8", "replace")
+
+
+def parse_version(text: str) -> dict:
+    # Version: ImageMagick 7.1.1-38 Q16-HDRI x64 ...
+    # Features: Cipher DPC HDRI Modules OpenMP(2.0)
+    values = {}
+
+    if match := re.search(r"ImageMagick (\S+) Q(\d+)", text):
+        values["version"] = match[1]
+        values["quantum_depth"] = int(match[2])
+
+    if match := re.search(r"^Features:(.*)$", text, re.MULTILINE):
+        features = match[1].split()
+        values["hdri"] = "HDRI" in features
+        values["openmp"] = any(x.startswith("OpenMP") for x in features)
+
+    return values
+
+
+def parse_resource(text: str) -> dict[str, int]:
+    # 単位付きの値 (メモリなど) は数値だけ読めるものを拾う
+    values = {}
+
+    for line in text.splitlines():
+        key, _, value = line.partition(":")
+        if value.strip().isdigit():
+            values[key.strip().lower()] = int(value)
+
+    return values
+
+
+def parse_formats(text: str) -> dict[str, str]:
+    #    BMP* BMP       rw-   Microsoft Windows bitmap image
+    formats = {}
+
+    for line in text.splitlines():
+        tokens = line.split()
+        if len(tokens) >= 3 and re.fullmatch(r"[r-][w-][+-]", tokens[2]):
+            formats[tokens[0].rstrip("*")] = tokens[2]
+
+    return formats
+
+
+def _stamp(binary: Path) -> list[int] | None:
+    for path in (binary, binary.with_suffix(".exe")):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        return [stat.st_size, stat.st_mtime_ns]
+    return None
@@ -2,6 +2,7 @@ import sys
 from enum import StrEnum
 from functools import cached_property
 from pathlib import Path
+from typing import NamedTuple
 
 APP_NAME = "WirthMage🧙"
 WINDOW_TITLE = f"{APP_NAME} :: CardWirth用画像コンバータ"
@@ -14,9 +15,21 @@ ROOT_PATH = (
 RESOURCE_PATH = Path(__file__).parent
 ASSETS_PATH = RESOURCE_PATH / "assets"
 MAGICK_PATH = RESOURCE_PATH / "lib/ImageMagick"
+# 同梱版の代わりに使う ImageMagick の実行ファイルを指定する環境変数
+MAGICK_ENV = "WIRTHMAGE_MAGICK"
 INPUT_PATH = Path.home() / "Pictures"
 OUTPUT_PATH = ROOT_PATH / "output"
 CONFIG_JSON = ROOT_PATH / "config.json"
+THUMBNAIL_PATH = ROOT_PATH / "cache" / "thumbnails"
+CAPABILITIES_JSON = ROOT_PATH / "cache" / "magick.json"
+PALETTE_PATH = ROOT_PATH / "cache" / "palettes"
+JOURNAL_PATH = ROOT_PATH / "cache" / "journals"
+REPORT_NAME = "wirthmage-errors.txt"
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 47821
+# リクエスト1行の上限 (input_files が多い config.json 形式も受け付ける)
+SERVER_LINE_LIMIT = 16 << 20
 
 INPUT_FILES_LABEL = "入力ファイル"
 ADD_LABEL = "追加"
@@ -25,6 +38,7 @@ CLEAR_LABEL = "クリア"
 OUTPUT_DIR_LABEL = "出力フォルダ"
 CHANGE_LABEL = "変更"
 OPEN_LABEL = "開く"
+OUTPUT_ZIP_LABEL = "ZIP書庫に保存"
 OUTPUT_SIZE_LABEL = "出力サイズ"
 OUTPUT_X2_LABEL = "2倍サイズ"
 OUTPUT_X4_LABEL = "4倍サイズ"
@@ -32,9 +46,15 @@ OUTPUT_FORMAT_LABEL = "出力形式"
 INDEXED_COLOR_LABEL = "減色"
 COLOR_MASK_LABEL = "透過色を保護"
 OUTLINE_STYLE_LABEL = "縁取り"
+OUTLINE_WIDTH_LABEL = "縁の太さ"
+QUALITY_LABEL = "品質"
+DITHER_METHOD_LABEL = "ディザ"
+ANIMATION_MODE_LABEL = "動画"
+JPEG_MAX_SIZE_LABEL = "JPEG上限"
 NOTICE_MESSAGES = (
     "※入力ファイルを変換し、出力フォルダに保存します。",
     "※出力フォルダ内の同名ファイルは上書きされます。",
+    "※同じ設定で変換済みのファイルは省略されます。",
 )
 EXECUTE_LABEL = "実行"
 QUIT_LABEL = "終了"
@@ -42,13 +62,18 @@ QUIT_LABEL = "終了"
 PROGRESS_TITLE = "進行中..."
 PROGRESS_LABEL = "{total}件中{current}番目が進行中..."
 CANCEL_LABEL = "キャンセル"
+FAILURE_MESSAGE = "{count}件の変換に失敗しました。\n詳細: {path}"
 
 FILE_DIALOG_TITLE = f"入力ファイルを選択 :: {APP_NAME}"
 FOLDER_DIALOG_TITLE = f"出力フォルダを選択 :: {APP_NAME}"
+ARCHIVE_DIALOG_TITLE = f"出力先のZIP書庫を選択 :: {APP_NAME}"
+ARCHIVE_TYPES = (("ZIP書庫", "*.zip"),)
 IMAGE_TYPES = (
-    ("画像ファイル", "*.bmp;*.png;*.jpg;*.jpeg;*.gif"),
+    ("画像ファイル", "*.bmp;*.png;*.jpg;*.jpeg;*.gif;*.zip"),
     ("すべてのファイル", "*.*"),
 )
+IMAGE_SUFFIXES = (".bmp", ".png", ".jpg", ".jpeg", ".gif")
+ARCHIVE_SUFFIXES = (".zip",)
 
 
 class ImageSize(StrEnum):
@@ -70,6 +95,7 @@ class ImageType(StrEnum):
 
 class IndexedColor(StrEnum):
     NONE = "なし"
+    AUTO = "自動"
     INDEXED_8BIT = "256色 (8-bit)"
     INDEXED_7BIT = "128色"
     INDEXED_6BIT = "64色"
@@ -81,9 +107,21 @@ class IndexedColor(StrEnum):
 
     @property
     def number(self):
+        # 自動の場合は上限の色数
+        if self.auto:
+            return 256
         c = self.name[-4]
         return 1 << int(c) if c.isdigit() else 0
 
+    @property
+    def auto(self) -> bool:
+        return self.name == "AUTO"
+
+
+# 減色の「自動」で許す量子化誤差
+# (各画素と置き換えた色との RGB 距離の二乗平均平方根、0〜255 の値で)
+AUTO_COLOR_ERROR = 6.0
+
 
 class OutlineStyle(StrEnum):
     NONE = "なし"
@@ -109,3 +147,104 @@ class OutlineStyle(StrEnum):
             if "OUTER_BLACK" in self.name
             else "white" if "OUTER_WHITE" in self.name else None
         )
+
+
+# 縁取りの太さ (等倍での画素数)
+OUTLINE_WIDTHS = (1, 2, 3, 4)
+
+# JPEG の1枚あたりの上限の選択肢 (バイト, 0 で画質固定)
+JPEG_MAX_SIZES = (0, 20_000, 50_000, 100_000, 200_000, 500_000)
+
+
+def jpeg_max_size_label(size: int) -> str:
+    return f"{size / 1000:g}KB" if size else "なし"
+
+
+class DitherMethod(StrEnum):
+    NONE = "なし"
+    ORDERED_4X4 = "組織的 4×4"
+    ORDERED_8X8 = "組織的 8×8"
+    RIEMERSMA = "Riemersma"
+    FLOYD_STEINBERG = "Floyd-Steinberg"
+
+    @cached_property
+    def ordered_map(self) -> str | None:
+        return (
+            "o4x4"
+            if self.name == "ORDERED_4X4"
+            else "o8x8" if self.name == "ORDERED_8X8" else None
+        )
+
+    @cached_property
+    def error_diffusion(self) -> str | None:
+        return (
+            "Riemersma"
+            if self.name == "RIEMERSMA"
+            else "FloydSteinberg" if self.name == "FLOYD_STEINBERG" else None
+        )
+
+
+class AnimationMode(StrEnum):
+    FIRST_FRAME = "先頭のみ"
+    ALL_FRAMES = "全フレーム"
+    SPRITE_SHEET = "横に連結"
+
+
+class QualityParams(NamedTuple):
+    resize_filter: str
+    sharpen: str | None
+    precolors: int
+    kmeans_sample: int
+    kmeans_iterations: int
+    # 誤差拡散ディザの割合 (%)
+    diffusion: int
+    jpeg_quality: int
+    jpeg_dct_method: str
+    png_compression_level: int
+
+
+class Quality(StrEnum):
+    DRAFT = "速度優先"
+    STANDARD = "標準"
+    FINAL = "品質優先"
+
+    @property
+    def params(self) -> QualityParams:
+        return QUALITY_PARAMS[self]
+
+
+QUALITY_PARAMS = {
+    Quality.DRAFT: QualityParams(
+        resize_filter="Triangle",
+        sharpen=None,
+        precolors=0x200,
+        kmeans_sample=0x10000,
+        kmeans_iterations=30,
+        diffusion=75,
+        jpeg_quality=75,
+        jpeg_dct_method="fast",
+        png_compression_level=3,
+    ),
+    Quality.STANDARD: QualityParams(
+        resize_filter="Hermite",
+        sharpen="0x.75",
+        precolors=0x800,
+        kmeans_sample=0x50000,
+        kmeans_iterations=300,
+        diffusion=75,
+        jpeg_quality=85,
+        jpeg_dct_method="fast",
+        png_compression_level=9,
+    ),
+    Quality.FINAL: QualityParams(
+        resize_filter="Lanczos",
+        sharpen="0x.75",
+        precolors=0x1000,
+        kmeans_sample=0x100000,
+        kmeans_iterations=1000,
+        diffusion=75,
+        jpeg_quality=92,
+        jpeg_dct_method="float",
+        png_compression_level=9,
+    ),
+}
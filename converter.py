@@ -1,18 +1,35 @@
 from __future__ import annotations
 
+import base64
 import math
 import subprocess
-import tempfile
+import time
+from collections.abc import Generator, Iterator
+from contextlib import contextmanager
 from enum import Enum
+from io import BytesIO
 from pathlib import Path
+from typing import NamedTuple
 
+import autocolor
+import capabilities
+import metrics
+import palettes
+import sources
 from constants import (
-    MAGICK_PATH,
+    AUTO_COLOR_ERROR,
+    AnimationMode,
+    DitherMethod,
     ImageSize,
     ImageType,
     IndexedColor,
     OutlineStyle,
+    Quality,
+    QualityParams,
 )
+from image_header import read_frame_count, read_size_from, split_images
+from launcher import command, limit_process, spawn_options
+from sinks import OutputSink, sink_for
 
 
 class Dimension:
@@ -72,9 +89,239 @@ class DimensionPreset(Dimension, Enum):
         return values[name] if name in values else None
 
 
+class ConversionError(Exception):
+
+    def __init__(self, returncode: int, stderr: bytes = b"") -> None:
+        self.returncode = returncode
+        self.stderr = stderr.decode("utf-8", "replace").strip()
+        super().__init__(f"magick exited with {returncode}: {self.stderr}")
+
+
+class FallbackWarning(UserWarning):
+    # 軽い設定でやり直して出力はできたが、選んだ設定の結果ではない
+    # 出力を使うかどうかは呼び出し側で決める
+
+    def __init__(
+        self,
+        path: Path,
+        outputs: list[Path],
+        error: BaseException,
+    ) -> None:
+        self.path = path
+        self.outputs = outputs
+        self.error = error
+        super().__init__(
+            f"{path}: converted with fallback options ({error!r})"
+        )
+
+
+# 時間切れや失敗のあとに一度だけ試す軽い設定
+# (k-means の標本を減らし、ディザをかけない)
+FALLBACK_OPTIONS = {
+    "quality": Quality.DRAFT,
+    "dither_method": DitherMethod.NONE,
+}
+
+
+class Command(NamedTuple):
+    params: tuple[str | Path, ...]
+    # 標準入力に流すデータ
+    input: bytes | None = None
+    # 計測用の処理段階の名前 (identify / prepare / palette / render)
+    stage: str = "render"
+
+
+JOBS = metrics.counter(
+    "wirthmage_jobs_total", "変換したファイル数 (status=done/failed)"
+)
+JOB_ERRORS = metrics.counter(
+    "wirthmage_job_errors_total", "変換に失敗したファイル数 (例外の種類別)"
+)
+JOB_SECONDS = metrics.histogram(
+    "wirthmage_job_seconds", "1件あたりの読み込みから書き出しまでの時間"
+)
+RETRIES = metrics.counter(
+    "wirthmage_retries_total",
+    "軽い設定でやり直した回数 (対象は FallbackWarning で知らせる)",
+)
+STAGE_SECONDS = metrics.histogram(
+    "wirthmage_stage_seconds", "magick 1回あたりの実行時間 (処理段階別)"
+)
+MAGICK_ERRORS = metrics.counter(
+    "wirthmage_magick_errors_total", "magick が異常終了した回数"
+)
+MAGICK_WARNINGS = metrics.counter(
+    "wirthmage_magick_warnings_total",
+    "magick が正常終了しつつ標準エラーに出力した回数",
+)
+BYTES_READ = metrics.counter(
+    "wirthmage_bytes_read_total", "読み込んだ入力のバイト数"
+)
+BYTES_WRITTEN = metrics.counter(
+    "wirthmage_bytes_written_total", "書き出した出力のバイト数"
+)
+QUEUE_DEPTH = metrics.gauge("wirthmage_queue_depth", "変換待ちの件数")
+PALETTE_CACHE = metrics.counter(
+    "wirthmage_palette_cache_total",
+    "保存済みのパレットの参照回数 (result=hit/miss)",
+)
+
+# 倍率ごとの変換結果 (全フレームを出力する場合はフレームのリスト)
+Images = dict[int, bytes | list[bytes]]
+
+# magick の実行内容を yield し、その実行結果を send で受け取るジェネレータ
+# 同期版・非同期版のどちらからも同じ手順で駆動できるようにしている
+Steps = Generator[
+    Command,
+    subprocess.CompletedProcess[bytes],
+    Images,
+]
+
+
 def convert(
     path: str | Path,
-    output_dir: str | Path,
+    output_dir: str | Path | OutputSink,
+    *,
+    timeout: float | None = None,
+    cpu_time: int | None = None,
+    retry: bool = False,
+    **options,
+) -> list[Path]:
+    # retry で軽い設定にやり直した場合は、書き出したあとに
+    # FallbackWarning を送出する
+    path = Path(path)
+    fallback = None
+
+    if not sources.exists(path):
+        raise FileNotFoundError
+
+    with job_metrics():
+        data = sources.read_bytes(path)
+        BYTES_READ.inc(len(data))
+
+        try:
+            images = convert_bytes(data, timeout, cpu_time, **options)
+        except (ConversionError, subprocess.TimeoutExpired) as e:
+            if not retry:
+                raise
+            RETRIES.inc()
+            fallback = e
+            options = {**options, **FALLBACK_OPTIONS}
+            images = convert_bytes(data, timeout, cpu_time, **options)
+
+        outputs = publish(path, images, output_dir, **options)
+
+    if fallback is not None:
+        raise FallbackWarning(path, outputs, fallback)
+
+    return outputs
+
+
+@contextmanager
+def job_metrics() -> Iterator[None]:
+    started = time.perf_counter()
+
+    try:
+        yield
+    except Exception as e:
+        JOBS.inc(status="failed")
+        JOB_ERRORS.inc(error=type(e).__name__)
+        raise
+
+    JOBS.inc(status="done")
+    JOB_SECONDS.observe(time.perf_counter() - started)
+
+
+def record_result(
+    command: Command,
+    result: subprocess.CompletedProcess[bytes],
+) -> None:
+    if result.returncode != 0:
+        MAGICK_ERRORS.inc(stage=command.stage)
+    elif result.stderr:
+        MAGICK_WARNINGS.inc(stage=command.stage)
+
+
+def convert_bytes(
+    data: bytes,
+    timeout: float | None = None,
+    cpu_time: int | None = None,
+    **options,
+) -> Images:
+    # timeout は1件分の全プロセスを通した経過時間の上限
+    deadline = time.monotonic() + timeout if timeout else None
+    steps = conversion_steps(data, **options)
+    result = None
+
+    try:
+        while True:
+            command = steps.send(result)  # type: ignore
+            with STAGE_SECONDS.time(stage=command.stage):
+                result = magick(
+                    *command.params,
+                    input=command.input,
+                    timeout=remaining(deadline),
+                    cpu_time=cpu_time,
+                )
+            record_result(command, result)
+    except StopIteration as e:
+        return e.value
+    except subprocess.TimeoutExpired as e:
+        # 残り時間ではなく1件分の上限として報告する
+        raise subprocess.TimeoutExpired(e.cmd, timeout or 0) from None
+    finally:
+        steps.close()
+
+
+def remaining(deadline: float | None) -> float | None:
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def publish(
+    path: str | Path,
+    images: Images,
+    output_dir: str | Path | OutputSink,
+    image_type: ImageType = ImageType.BMP,
+    **_,
+) -> list[Path]:
+    outputs = []
+
+    # 書庫への出力などバッチ全体で共有する場合は OutputSink を渡す
+    with sink_for(output_dir) as sink:
+        for x, data in images.items():
+            if isinstance(data, bytes):
+                names = [(output_name(path, x, image_type), data)]
+            else:
+                names = [
+                    (output_name(path, x, image_type, i), frame)
+                    for i, frame in enumerate(data, 1)
+                ]
+
+            for name, frame in names:
+                output_path = sink.write(name, frame)
+                BYTES_WRITTEN.inc(len(frame))
+                print(output_path)
+                outputs.append(output_path)
+
+    return outputs
+
+
+def output_name(
+    path: str | Path,
+    x: int,
+    image_type: ImageType,
+    frame: int | None = None,
+) -> str:
+    ext = f".{image_type.ext}" if x == 1 else f".x{x}.{image_type.ext}"
+    if frame is not None:
+        ext = f".{frame:03}{ext}"
+    return Path(Path(path).name).with_suffix(ext).name
+
+
+def conversion_steps(
+    data: bytes,
     image_size: ImageSize = ImageSize.ASIS,
     output_x2: bool = False,
     output_x4: bool = False,
@@ -82,34 +329,70 @@ def convert(
     indexed_color: IndexedColor = IndexedColor.NONE,
     color_mask: bool = False,
     outline_style: OutlineStyle = OutlineStyle.NONE,
-) -> None:
+    outline_width: int = 1,
+    quality: Quality = Quality.STANDARD,
+    dither_method: DitherMethod = DitherMethod.FLOYD_STEINBERG,
+    animation_mode: AnimationMode = AnimationMode.FIRST_FRAME,
+    color_error: float = AUTO_COLOR_ERROR,
+    jpeg_max_size: int = 0,
+    jpeg_bytes_per_pixel: float = 0,
+    memory_limit: int = 0,
+    thread_limit: int = 0,
+    # 求めたパレットを保存・再利用する (ディスクに書くのでバッチ処理だけで使う)
+    palette_cache: bool = False,
+) -> Steps:
+
+    # 出力形式に対応していない ImageMagick では読み込む前に諦める
+    if not capabilities.current().can_write(image_type.name):
+        raise ValueError(f"ImageMagick cannot write {image_type.name}")
+
+    # 入力も出力もファイルを介さず標準入出力でやりとりする
+    # ヘッダから読めればサイズ取得のために magick を起動しない
+    if size := read_size_from(BytesIO(data)):
+        source_size = Dimension(*size)
+    else:
+        command = Command(dimension_params("-"), data, "identify")
+        source_size = parse_dimension((yield command))
 
-    path = Path(path)
-
-    if not path.is_file():
-        raise FileNotFoundError
-
-    output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    source_size = get_dimension(path)
     target_size = DimensionPreset.of(image_size)
     colors = indexed_color.number
+    knobs = quality.params
+    # 自動の減色で前の倍率が選んだ色数 (次の倍率の探索の起点にする)
+    hint = None
+    images: Images = {}
+
+    # 先頭フレームだけ使う場合は残りのフレームを読み込まない
+    source = "-"
+    frames = read_frame_count(BytesIO(data))
+    if frames > 1 and animation_mode == AnimationMode.FIRST_FRAME:
+        source = "-[0]"
+        frames = 1
+
+    # 入力を読む前に指定しないと効かない
+    # 上限を超えた分はディスクのピクセルキャッシュに逃がされる
+    limits = (
+        ("-limit", "memory", str(memory_limit))
+        + ("-limit", "map", str(memory_limit * 2))
+        if memory_limit
+        else ()
+    )
+    if thread_limit:
+        limits += ("-limit", "thread", str(thread_limit))
 
-    for x in 1, 2, 4:
-        if x == 2 and not output_x2:
-            continue
-        if x == 4 and not output_x4:
-            continue
+    scales = [1]
+    if target_size:
+        if output_x2:
+            scales.append(2)
+        if output_x4:
+            scales.append(4)
 
-        ext = f".{image_type.ext}" if x == 1 else f".x{x}.{image_type.ext}"
-        output_path = (output_dir / path.name).with_suffix(ext)
+    for x in scales:
         output_size = target_size.scale(x) if target_size else source_size
-
-        # -remap mpr:palette ではうまくいかない
-        palette_path = Path(tempfile.mktemp(suffix=".png"))
+        # 最後に出力する magick の入力 (減色する場合は中間画像)
+        render_source, render_input = source, data
 
         # 左上ピクセルから背景色を設定
-        # PNG圧縮は遅いので一時ファイル用に圧縮レベルを下げておく
+        # PNG圧縮は遅いので中間データ用に圧縮レベルを下げておく
         params = """
         -background %[pixel:p{0,0}]
         -define png:compression-level=1
@@ -131,16 +414,20 @@ def convert(
         if target_size:
             params += f"""
             -gravity Center
-            -filter Hermite
+            -filter {knobs.resize_filter}
             -resize {output_size}^
             -crop {output_size}+0+0 +repage
             """
 
-            if output_size.pixels < 0x8000 and output_size != source_size:
+            if (
+                knobs.sharpen
+                and output_size.pixels < 0x8000
+                and output_size != source_size
+            ):
                 # 出力サイズが小さい場合はシャープフィルタをかける
-                params += """
+                params += f"""
                 -channel RGB
-                -sharpen 0x.75
+                -sharpen {knobs.sharpen}
                 """
 
         if color_mask:
@@ -154,59 +441,187 @@ def convert(
         -write mpr:base
         """
 
-        if color_mask:
+        if color_mask and (outline_style.inner or outline_style.outer):
+            # 2値化したアルファチャンネルをマスクとして一度だけ取り出し、
+            # 内側は EdgeIn、外側は EdgeOut で縁の領域を求める
+            # 縁の部分だけ不透明な塗り色の層を作って元画像に重ねる
+            # 高解像度版でも見た目が同じになるよう太さは倍率に合わせる
+            kernel = f"Diamond:{outline_width * x}"
+            params += """
+            -channel RGBA
+            -alpha extract
+            -write mpr:mask
+            +delete
+            mpr:base
+            """
 
-            if fill := outline_style.inner:
-                params += f"""
-                -alpha remove
-                +transparent %[pixel:p{{0,0}}]
-                -channel A
-                -morphology Dilate Diamond
-                -transparent %[pixel:p{{0,0}}]
-                -channel RGB
-                -fill {fill}
-                -colorize 100%
+            for fill, edge in (
+                (outline_style.inner, "EdgeIn"),
+                (outline_style.outer, "EdgeOut"),
+            ):
+                if fill:
+                    params += f"""
+                    (
+                    mpr:base
+                    -fill {fill}
+                    -colorize 100%
+                    mpr:mask
+                    -morphology {edge} {kernel}
+                    -compose CopyOpacity
+                    -composite
+                    )
+                    -compose Over
+                    -composite
+                    """
+
+        if frames > 1:
+            # 重ね合わせた各フレームに1枚ずつ同じ処理をかけ、
+            # 元のフレームは捨てる (以降の処理はフレームごとにかかる)
+            clones = " ".join(
+                f"( -clone {i} {params} )" for i in range(frames)
+            )
+            params = f"""
+            -coalesce
+            {clones}
+            -delete 0-{frames - 1}
+            """
 
-                mpr:base
-                +swap
-                -channel RGBA
-                -composite
-                -write mpr:base
+            if animation_mode == AnimationMode.SPRITE_SHEET:
+                params += """
+                +append
                 """
 
-            if fill := outline_style.outer:
+        if colors:
+            # 読み込みから縁取りまでは一度だけ行って中間画像を MIFF で受け取り、
+            # パレットを求める処理と -remap 以降の処理はどちらもそれを読む
+            # (MIFF なら深度や背景色、フレームの情報もそのまま引き継がれる)
+            prepare_params = (source, *params.split())
+            result = yield Command(
+                (*limits, *prepare_params, "MIFF:-"), data, "prepare"
+            )
+
+            if result.returncode != 0:
+                raise ConversionError(result.returncode, result.stderr)
+
+            render_source, render_input = "MIFF:-", result.stdout
+            params = ""
+
+            # パレットは別プロセスで求めて PNG で受け取る
+            # -remap mpr:palette ではうまくいかないので inline: で渡す
+            # 複数フレームは横に並べて全フレーム共通のパレットにする
+            sample_size = Dimension(
+                output_size.width * frames, output_size.height
+            )
+            sample_params = "+append" if frames > 1 else ""
+            sample_params += f"""
+            -channel RGB
+            -filter Point
+            -resize {sample_size.limit_pixels(knobs.kmeans_sample)}>
+            +dither
+            -colors {knobs.precolors}
+            """
+
+            if indexed_color.auto:
+                # 標本を一度だけ作り、色数を変えて試すのは標本に対して行う
+                palette_command = (
+                    render_source,
+                    *sample_params.split(),
+                    "-channel",
+                    "RGBA",
+                    "-depth",
+                    "8",
+                    "PAM:-",
+                )
+                palette_key = (
+                    *prepare_params,
+                    *palette_command,
+                    "auto",
+                    color_error,
+                )
+            else:
+                palette_command = (
+                    render_source,
+                    *sample_params.split(),
+                    *reduce_params(colors, knobs),
+                    "PNG:-",
+                )
+                palette_key = (*prepare_params, *palette_command)
+
+            # 同じ入力を同じ設定で変換したことがあれば k-means を省く
+            # 使用メモリなどの上限は結果に影響しないのでキーに含めない
+            palette_data = None
+            if palette_cache:
+                store = palettes.default_store()
+                key = store.key(
+                    data, (capabilities.current().version, *palette_key)
+                )
+                palette_data = store.get(key)
+                hit = palette_data is not None
+                PALETTE_CACHE.inc(result="hit" if hit else "miss")
+
+            if palette_data is None:
+                if indexed_color.auto:
+                    palette_data = yield from auto_palette(
+                        (*limits, *palette_command),
+                        render_input,
+                        knobs,
+                        color_error,
+                        hint,
+                    )
+                else:
+                    result = yield Command(
+                        (*limits, *palette_command),
+                        render_input,
+                        "palette",
+                    )
+
+                    if result.returncode != 0:
+                        raise ConversionError(result.returncode, result.stderr)
+
+                    palette_data = result.stdout
+
+                if palette_cache:
+                    store.put(key, palette_data)
+
+            # 自動の場合は選んだ色数 (パレット画像の幅)
+            palette_colors = colors
+            if indexed_color.auto:
+                size = read_size_from(BytesIO(palette_data))
+                palette_colors = size[0] if size else colors
+                hint = palette_colors
+
+            palette = base64.b64encode(palette_data).decode("ascii")
+
+            params += """
+            -channel RGBA
+            """
+
+            if method := dither_method.error_diffusion:
+                # 品質プリセットによらず選んだディザをかける
                 params += f"""
-                -channel A
-                -morphology Dilate Diamond
-                -channel RGB
-                -fill {fill}
-                -colorize 100%
+                -define dither:diffusion-amount={knobs.diffusion}%
+                -dither {method}
+                """
 
-                mpr:base
+            elif threshold_map := dither_method.ordered_map:
+                # -remap は組織的ディザに対応していないので、
+                # パレットの色数に見合った階調で組織的ディザをかけてから
+                # ディザなしで最も近いパレット色に置き換える
+                levels = max(2, round(palette_colors ** (1 / 3)) + 1)
+                params += f"""
+                -channel RGB
+                -ordered-dither {threshold_map},{levels}
                 -channel RGBA
-                -composite
-                -write mpr:base
+                +dither
                 """
 
-        if colors:
-            # 重いので大きな画像はピクセル数と色数を減らして計算
-            temp_size = source_size.limit_pixels(0x50000)
+            else:
+                params += """
+                +dither
+                """
 
             params += f"""
-            -channel RGB
-            -filter Point
-            -resize {temp_size}>
-            +dither
-            -colors {0x800}
-            -kmeans {colors}
-            -channel RGBA
-            -write {palette_path}
-            +delete
-
-            mpr:base
-            -define dither:diffusion-amount=75%
-            -dither FloydSteinberg
-            -remap {palette_path}
+            -remap inline:data:image/png;base64,{palette}
             """
 
         if colors or color_mask:
@@ -223,41 +638,239 @@ def convert(
             """
 
         elif image_type == ImageType.PNG:
-            params += """
-            -define png:compression-level=9
+            params += f"""
+            -define png:compression-level={knobs.png_compression_level}
             -define png:compression-filter=5
             """
 
-        elif image_type == ImageType.JPEG:
-            params += """
-            -define jpeg:dct-method=fast
-            -sampling-factor 4:2:0
-            -quality 85
-            -interlace JPEG
-            """
+        # JPEG の出力1枚あたりの上限 (バイト, 0 なら画質固定)
+        max_size = 0
+        if image_type == ImageType.JPEG:
+            pixels = output_size.pixels
+            if animation_mode == AnimationMode.SPRITE_SHEET:
+                pixels *= frames
+            # バッチ全体の予算から割り振った分と1枚ごとの上限の小さい方
+            budget = int(jpeg_bytes_per_pixel * pixels)
+            max_size = min(
+                (x for x in (jpeg_max_size, budget) if x > 0), default=0
+            )
+
+        if image_type == ImageType.JPEG and not max_size:
+            params += " " + " ".join(jpeg_params(knobs, knobs.jpeg_quality))
+
+        params += " -strip"
+
+        if max_size:
+            # 画質を変えて何度も符号化するので、JPEG にする直前までを
+            # 済ませた画像を無圧縮の PAM で受け取っておく
+            result = yield Command(
+                (
+                    *limits,
+                    render_source,
+                    *params.split(),
+                    "-depth",
+                    "8",
+                    "PAM:-",
+                ),
+                render_input,
+            )
+
+            if result.returncode != 0:
+                raise ConversionError(result.returncode, result.stderr)
+
+            output = yield from fit_jpeg(
+                result.stdout,
+                knobs,
+                max_size,
+                frames > 1 and animation_mode == AnimationMode.ALL_FRAMES,
+            )
+
+        else:
+            result = yield Command(
+                (
+                    *limits,
+                    render_source,
+                    *params.split(),
+                    f"{image_type.name}:-",
+                ),
+                render_input,
+            )
+
+            if result.returncode != 0:
+                raise ConversionError(result.returncode, result.stderr)
+
+            output = result.stdout
+
+        if frames > 1 and animation_mode == AnimationMode.ALL_FRAMES:
+            # 全フレームが連結されて出力されるので1枚ずつに分ける
+            images[x] = split_images(output, image_type.ext)
+        else:
+            images[x] = output
+
+    return images
+
+
+def jpeg_params(knobs: QualityParams, quality: int) -> tuple[str, ...]:
+    return (
+        "-define",
+        f"jpeg:dct-method={knobs.jpeg_dct_method}",
+        "-sampling-factor",
+        "4:2:0",
+        "-quality",
+        str(quality),
+        "-interlace",
+        "JPEG",
+    )
+
+
+def fit_jpeg(
+    image: bytes,
+    knobs: QualityParams,
+    max_size: int,
+    all_frames: bool = False,
+) -> Generator[Command, subprocess.CompletedProcess[bytes], bytes]:
+    # 画質を二分探索し、max_size 以下に収まる最も高い画質の JPEG を返す
+    # 試した結果は標準出力で受け取り、ファイルには書き出さない
+    # 最低画質でも収まらなければ最も小さかったものを返す
+
+    def encode(
+        quality: int,
+    ) -> Generator[Command, subprocess.CompletedProcess[bytes], bytes]:
+        result = yield Command(
+            ("PAM:-", *jpeg_params(knobs, quality), "JPEG:-"),
+            image,
+            "encode",
+        )
+        if result.returncode != 0:
+            raise ConversionError(result.returncode, result.stderr)
+        return result.stdout
+
+    def size(data: bytes) -> int:
+        # 全フレームを出力する場合は1枚ずつの上限とする
+        if all_frames:
+            return max(map(len, split_images(data, "jpg")), default=0)
+        return len(data)
+
+    # 多くの場合は既定の画質のまま収まるので最初に試す
+    smallest = yield from encode(knobs.jpeg_quality)
+    if size(smallest) <= max_size:
+        return smallest
+
+    best = None
+    lo, hi = 1, knobs.jpeg_quality - 1
+
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        output = yield from encode(quality)
+        if size(output) <= max_size:
+            best = output
+            lo = quality + 1
+        else:
+            smallest = min(smallest, output, key=size)
+            hi = quality - 1
+
+    return smallest if best is None else best
+
+
+def reduce_params(colors: int, knobs: QualityParams) -> tuple[str, ...]:
+    # 標本をパレットの色数まで減らして色の一覧にする
+    # -kmeans のない古い ImageMagick では色数を直接減らす
+    if capabilities.current().kmeans:
+        reduce = ("-kmeans", f"{colors},{knobs.kmeans_iterations}")
+    else:
+        reduce = ("-colors", str(colors))
+
+    return ("-channel", "RGB", *reduce, "-channel", "RGBA", "-unique-colors")
+
+
+def auto_palette(
+    sample_command: tuple[str | Path, ...],
+    data: bytes,
+    knobs: QualityParams,
+    target: float,
+    hint: int | None = None,
+) -> Generator[Command, subprocess.CompletedProcess[bytes], bytes]:
+    # 誤差が target 以下になる最小の色数のパレットを PNG で返す
+    result = yield Command(sample_command, data, "sample")
+    if result.returncode != 0:
+        raise ConversionError(result.returncode, result.stderr)
+
+    sample = result.stdout
+    depth, histogram = autocolor.histogram(sample)
+    found: dict[int, list[bytes]] = {}
+
+    def probe(
+        colors: int,
+    ) -> Generator[Command, subprocess.CompletedProcess[bytes], list[bytes]]:
+        # 標本の色数が候補以下なら k-means をかけずにそのまま使う
+        if len(histogram) <= colors:
+            return list(histogram)
+
+        result = yield Command(
+            (
+                "PAM:-",
+                *reduce_params(colors, knobs),
+                "-depth",
+                "8",
+                "PAM:-",
+            ),
+            sample,
+            "palette",
+        )
+        if result.returncode != 0:
+            raise ConversionError(result.returncode, result.stderr)
+
+        return autocolor.palette_colors(result.stdout)[1]
+
+    search = autocolor.search(target, hint)
+    try:
+        colors = next(search)
+        while True:
+            found[colors] = yield from probe(colors)
+            colors = search.send(autocolor.error(histogram, found[colors]))
+    except StopIteration as e:
+        colors = e.value
 
-        params += "-strip"
-        params = params.strip().split()
+    if colors not in found:
+        found[colors] = yield from probe(colors)
 
-        if magick(path, *params, output_path).returncode == 0:
-            print(output_path)
+    return autocolor.encode_png(depth, found[colors])
 
-        palette_path.unlink(True)
 
-        if image_size == ImageSize.ASIS:
-            break
+def dimension_params(path: str | Path) -> tuple[str | Path, ...]:
+    # アニメーションGIFはフレームごとに出力されるので1行目だけ使う
+    return "identify", "-format", "%w %h\n", path
 
 
-def get_dimension(path: str | Path):
-    result = magick("identify", "-format", "%w %h", path)
-    width, height = result.stdout.split()
+def parse_dimension(result: subprocess.CompletedProcess[bytes]) -> Dimension:
+    if result.returncode != 0:
+        raise ConversionError(result.returncode, result.stderr)
+    width, height = result.stdout.split()[:2]
     return Dimension(int(width), int(height))
 
 
-def magick(*params: str | Path):
-    return subprocess.run(
-        (MAGICK_PATH / "magick", *params),
-        creationflags=subprocess.CREATE_NO_WINDOW,
+def magick(
+    *params: str | Path,
+    input: bytes | None = None,
+    timeout: float | None = None,
+    cpu_time: int | None = None,
+):
+    # 時間切れの場合は子プロセスを止めて TimeoutExpired を送出する
+    with subprocess.Popen(
+        command(params),
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
+        **spawn_options(cpu_time),
+    ) as process:
+        limit_process(process.pid, cpu_time)
+        try:
+            stdout, stderr = process.communicate(input, timeout)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+
+    return subprocess.CompletedProcess(
+        params, process.returncode, stdout, stderr
     )
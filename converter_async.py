@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import subprocess
+import time
+from collections.abc import AsyncIterator, Iterable
+from contextlib import suppress
+from pathlib import Path
+from typing import NamedTuple
+
+import sources
+from converter import (
+    BYTES_READ,
+    FALLBACK_OPTIONS,
+    RETRIES,
+    STAGE_SECONDS,
+    ConversionError,
+    Command,
+    FallbackWarning,
+    Images,
+    Steps,
+    conversion_steps,
+    job_metrics,
+    publish,
+    record_result,
+    remaining,
+)
+from journal import BatchJournal
+from launcher import command, limit_process, spawn_options
+from sinks import OutputSink, sink_for
+
+
+class Completed(NamedTuple):
+    path: Path
+    error: BaseException | None = None
+    outputs: list[Path] = []
+
+
+async def magick_async(
+    *params: str | Path,
+    input: bytes | None = None,
+    timeout: float | None = None,
+    cpu_time: int | None = None,
+) -> subprocess.CompletedProcess[bytes]:
+    process = await asyncio.create_subprocess_exec(
+        *command(params),
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **spawn_options(cpu_time),
+    )
+    limit_process(process.pid, cpu_time)
+
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            process.communicate(input), timeout
+        )
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise subprocess.TimeoutExpired(params, timeout or 0)
+    except BaseException:
+        # キャンセルやタイムアウトで中断されたら子プロセスも止める
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    return subprocess.CompletedProcess(
+        params, process.returncode or 0, stdout, stderr
+    )
+
+
+async def convert_async(
+    path: str | Path,
+    output_dir: str | Path | OutputSink,
+    *,
+    timeout: float | None = None,
+    cpu_time: int | None = None,
+    retry: bool = False,
+    **options,
+) -> list[Path]:
+    path = Path(path)
+    fallback = None
+
+    # 大きな入力の読み込みや書庫への圧縮でイベントループを止めないよう
+    # ファイルの読み書きは別スレッドで行う
+    if not await asyncio.to_thread(sources.exists, path):
+        raise FileNotFoundError
+
+    with job_metrics():
+        data = await asyncio.to_thread(sources.read_bytes, path)
+        BYTES_READ.inc(len(data))
+
+        try:
+            images = await convert_bytes_async(
+                data, timeout, cpu_time, **options
+            )
+        except (ConversionError, subprocess.TimeoutExpired) as e:
+            if not retry:
+                raise
+            RETRIES.inc()
+            fallback = e
+            options = {**options, **FALLBACK_OPTIONS}
+            images = await convert_bytes_async(
+                data, timeout, cpu_time, **options
+            )
+
+        outputs = await asyncio.to_thread(
+            publish, path, images, output_dir, **options
+        )
+
+    if fallback is not None:
+        raise FallbackWarning(path, outputs, fallback)
+
+    return outputs
+
+
+async def convert_bytes_async(
+    data: bytes,
+    timeout: float | None = None,
+    cpu_time: int | None = None,
+    **options,
+) -> Images:
+    deadline = time.monotonic() + timeout if timeout else None
+    steps = conversion_steps(data, **options)
+    result = None
+
+    try:
+        while True:
+            # magick の実行の合間の処理 (自動の減色の誤差の計算や
+            # パレットの読み書きなど) でイベントループを止めないよう、
+            # 手順は別スレッドで進める
+            command, images = await asyncio.to_thread(_advance, steps, result)
+            if command is None:
+                return images
+            with STAGE_SECONDS.time(stage=command.stage):
+                result = await magick_async(
+                    *command.params,
+                    input=command.input,
+                    timeout=remaining(deadline),
+                    cpu_time=cpu_time,
+                )
+            record_result(command, result)
+    except subprocess.TimeoutExpired as e:
+        # 残り時間ではなく1件分の上限として報告する
+        raise subprocess.TimeoutExpired(e.cmd, timeout or 0) from None
+    finally:
+        # キャンセルされたときは別スレッドで進めている途中の場合があり、
+        # その場合はガベージコレクタに閉じさせる
+        with suppress(ValueError):
+            steps.close()
+
+
+def _advance(
+    steps: Steps,
+    result: subprocess.CompletedProcess[bytes] | None,
+) -> tuple[Command | None, Images]:
+    # StopIteration は Future に渡せないので終了を戻り値で知らせる
+    try:
+        return steps.send(result), {}  # type: ignore
+    except StopIteration as e:
+        return None, e.value
+
+
+async def as_completed(
+    paths: Iterable[str | Path],
+    output_dir: str | Path | OutputSink,
+    limit: int = os.cpu_count() or 1,
+    timeout: float | None = None,
+    journal: BatchJournal | None = None,
+    **options,
+) -> AsyncIterator[Completed]:
+
+    async def run(path: Path) -> Completed:
+        if journal and await asyncio.to_thread(journal.is_done, path):
+            return Completed(path)
+        try:
+            outputs = await convert_async(
+                path, sink, timeout=timeout, **options
+            )
+        except asyncio.CancelledError:
+            raise
+        except FallbackWarning as e:
+            # 選んだ設定の結果ではないので記録には残さない
+            return Completed(path, e, e.outputs)
+        except Exception as e:
+            return Completed(path, e)
+        if journal:
+            await asyncio.to_thread(journal.record, path, outputs)
+        return Completed(path, outputs=outputs)
+
+    # 同時実行数を limit に抑えるため、タスクは空きができた分だけ作る
+    pending: set[asyncio.Task[Completed]] = set()
+    paths = iter(paths)
+
+    with sink_for(output_dir) as sink:
+        try:
+            while True:
+                while len(pending) < max(1, limit):
+                    if (path := next(paths, None)) is None:
+                        break
+                    pending.add(asyncio.create_task(run(Path(path))))
+
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    yield task.result()
+
+        finally:
+            # 途中で打ち切られた場合は実行中の変換をすべてキャンセル
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
@@ -4,11 +4,15 @@ from pathlib import Path
 from typing import Any
 
 from constants import (
+    AUTO_COLOR_ERROR,
     OUTPUT_PATH,
+    AnimationMode,
+    DitherMethod,
     ImageSize,
     ImageType,
     IndexedColor,
     OutlineStyle,
+    Quality,
 )
 
 
@@ -20,8 +24,40 @@ class ConverterParams:
     output_x4: bool = False
     image_type: ImageType = ImageType.BMP
     indexed_color: IndexedColor = IndexedColor.NONE
+    # 減色が「自動」のときに許す誤差
+    color_error: float = AUTO_COLOR_ERROR
+    # JPEG の1枚あたりの上限 (バイト, 0 で画質固定)
+    jpeg_max_size: int = 0
     color_mask: bool = False
     outline_style: OutlineStyle = OutlineStyle.NONE
+    outline_width: int = 1
+    quality: Quality = Quality.STANDARD
+    dither_method: DitherMethod = DitherMethod.FLOYD_STEINBERG
+    animation_mode: AnimationMode = AnimationMode.FIRST_FRAME
+    # 同時変換の推定メモリ合計の上限 (MiB, 0 で物理メモリの半分)
+    memory_budget: int = 0
+    # 1件あたりの経過時間・CPU時間の上限 (秒, 0 で無制限)
+    job_timeout: int = 300
+    cpu_time_limit: int = 0
+    # 失敗や時間切れのとき軽い設定で一度だけやり直す
+    # (やり直した分は失敗の報告に載せ、変換済みとしては記録しない)
+    retry_cheaper: bool = False
+    # 計測値の書き出し先 (.json なら JSON、それ以外は Prometheus 形式)
+    metrics_file: str = ""
+    # JPEG の出力全体の上限 (バイト, 0 で無制限)
+    jpeg_budget: int = 0
+
+    # 変換ごとではなくバッチ全体に対する設定
+    batch_keys = (
+        "input_files",
+        "output_dir",
+        "memory_budget",
+        "job_timeout",
+        "cpu_time_limit",
+        "retry_cheaper",
+        "metrics_file",
+        "jpeg_budget",
+    )
 
     def __init__(self) -> None:
         self.input_files = {}
@@ -42,6 +78,9 @@ class ConverterParams:
         with open(path, "r", encoding="utf-8") as fp:
             data = json.load(fp)
 
+        self.update(data)
+
+    def update(self, data: Any) -> None:
         if not isinstance(data, dict):
             raise Exception
 
@@ -64,6 +103,21 @@ class ConverterParams:
 
             self.__setattr__(key, value)
 
+    def options(self) -> dict[str, Any]:
+        # convert() にそのまま渡せる変換設定
+        return {
+            key: getattr(self, key)
+            for key in self.__annotations__
+            if key not in self.batch_keys
+        }
+
+    def job_limits(self) -> dict[str, Any]:
+        return {
+            "timeout": self.job_timeout or None,
+            "cpu_time": self.cpu_time_limit or None,
+            "retry": self.retry_cheaper,
+        }
+
     def save(self, path: str | Path) -> None:
         data = {**vars(self)}
 
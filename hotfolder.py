@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import argparse
+import os
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import suppress
+from pathlib import Path
+
+import sources
+from constants import CONFIG_JSON
+from converter_params import ConverterParams
+
+# 入力フォルダを見張り、置かれたファイルを順次変換する常駐モード
+#
+#   python app.py --watch <フォルダ> [<フォルダ>...]
+#
+# 書き込み中のファイルを読まないよう、サイズと更新日時が settle 秒
+# 変わらなくなったものだけを変換する。変換中に揃ったファイルは
+# 次のバッチにまとめるので、大量に置かれても1件ずつ処理しない。
+# 設定は config.json (GUI で最後に保存したもの) を使う。
+
+
+class HotFolder:
+
+    def __init__(
+        self,
+        folders: Iterable[str | Path],
+        config: str | Path = CONFIG_JSON,
+        output_dir: str | Path | None = None,
+        interval: float = 1,
+        settle: float = 2,
+        batch_size: int = 1000,
+        jobs: int = 0,
+        recursive: bool = False,
+    ) -> None:
+
+        self.folders = [Path(x).absolute() for x in folders]
+        self.config = Path(config)
+        self.output_dir = output_dir
+        self.interval = interval
+        self.settle = settle
+        self.batch_size = max(1, batch_size)
+        self.jobs = jobs
+        self.recursive = recursive
+        # 見つけてから変化がないか見ているファイルと最後に変化した時刻
+        self.changing: dict[Path, tuple[list[int], float]] = {}
+        # 変換に回したファイルとそのときの状態 (変わったら変換し直す)
+        self.handled: dict[Path, list[int]] = {}
+        self.ready: list[Path] = []
+        # 出力名 (出力先と、拡張子を除いたファイル名) ごとに最後に使った入力
+        self.owners: dict[tuple[Path, str], Path] = {}
+        self.batch: threading.Thread | None = None
+        self.params: ConverterParams | None = None
+        self.params_stamp: list[int] | None = None
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        try:
+            while not self.stopped.is_set():
+                self.poll()
+                self.stopped.wait(self.interval)
+        finally:
+            if self.batch is not None:
+                self.batch.join()
+
+    def poll(self) -> None:
+        count = len(self.ready)
+        self.ready.extend(self.scan())
+
+        if not self.ready or self._busy():
+            return
+
+        # 揃い続けている間は次の走査まで待ってまとめる
+        if len(self.ready) == count or len(self.ready) >= self.batch_size:
+            paths = self.ready[: self.batch_size]
+            del self.ready[: self.batch_size]
+            self.batch = threading.Thread(
+                target=self.run_batch, args=(paths,), daemon=True
+            )
+            self.batch.start()
+
+    def scan(self) -> list[Path]:
+        # 変化しなくなったファイルを返す
+        now = time.monotonic()
+        found = set()
+        ready = []
+
+        for path in self._walk():
+            found.add(path)
+            stamp = sources.stamp(path)
+            if stamp is None or self.handled.get(path) == stamp:
+                continue
+
+            last = self.changing.get(path)
+            if last is None or last[0] != stamp:
+                self.changing[path] = stamp, now
+            elif now - last[1] >= self.settle:
+                del self.changing[path]
+                self.handled[path] = stamp
+                ready.append(path)
+
+        # 消えたファイルは忘れる (同じ名前で置き直されたら変換する)
+        for path in (*self.changing, *self.handled):
+            if path not in found:
+                self.changing.pop(path, None)
+                self.handled.pop(path, None)
+
+        return ready
+
+    def _walk(self) -> Iterator[Path]:
+        output_dir = self.settings().output_dir.absolute()
+        stack = list(self.folders)
+
+        while stack:
+            folder = stack.pop()
+            try:
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+
+            for entry in entries:
+                if entry.name.startswith("."):
+                    # 書き出し途中の一時ファイルなど
+                    continue
+                path = Path(entry.path)
+                if path.is_relative_to(output_dir):
+                    # 出力先 (フォルダや書庫) が入力フォルダの中にある場合、
+                    # 出力を入力として変換し直し続けないよう見ない
+                    continue
+                with suppress(OSError):
+                    if entry.is_dir():
+                        if self.recursive:
+                            stack.append(path)
+                    elif sources.is_image(path) or sources.is_archive(path):
+                        yield path
+
+    def _busy(self) -> bool:
+        return self.batch is not None and self.batch.is_alive()
+
+    def settings(self) -> ConverterParams:
+        # 見張っている間に GUI で設定を変えたら次のバッチから反映する
+        stamp = sources.stamp(self.config)
+        if self.params is None or self.params_stamp != stamp:
+            self.params = ConverterParams()
+            self.params.load(self.config)
+            if self.output_dir is not None:
+                self.params.output_dir = self.output_dir
+            self.params_stamp = stamp
+
+            output_dir = self.params.output_dir.absolute()
+            for folder in self.folders:
+                if folder.is_relative_to(output_dir):
+                    log(f"{folder}: 出力先の中にあるため変換しません")
+        return self.params
+
+    def _claim(self, output_dir: Path, path: Path) -> Path | None:
+        # 出力はフォルダ構成を保たず出力先に並ぶので、別のフォルダの
+        # 同じ名前のファイルは同じ出力になる
+        # 別の入力がその出力名を使っていればその入力を返す
+        key = output_dir.absolute(), path.stem.lower()
+        owner = self.owners.get(key)
+        if owner is not None and owner != path and sources.exists(owner):
+            return owner
+        self.owners[key] = path
+        return None
+
+    def run_batch(self, paths: list[Path]) -> None:
+        from batch import run_batch
+        from report import describe
+
+        params = self.settings()
+        inputs = []
+        for path in paths:
+            for x in sources.iter_inputs(path):
+                # 黙って上書きしないよう、先に変換した方を残す
+                if (owner := self._claim(params.output_dir, x)) is not None:
+                    log(
+                        f"{x}: {owner} と出力ファイル名が重なるため変換しません"
+                    )
+                else:
+                    inputs.append(x)
+
+        def on_done(path: Path, error: Exception | None) -> None:
+            if error is not None:
+                log(f"{path}: {describe(error)}")
+
+        started = time.perf_counter()
+        log(f"{len(inputs)} files -> {params.output_dir}")
+
+        report, _ = run_batch(inputs, params, self.jobs, on_done)
+
+        log(
+            f"{len(inputs) - len(report)} done, {len(report)} failed"
+            f" ({time.perf_counter() - started:.1f}s)"
+        )
+
+
+def log(message: str) -> None:
+    # 常駐中の状況は時刻を付けて1行ずつ標準出力に流す
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="WirthMage --watch")
+    parser.add_argument("folders", type=Path, nargs="+")
+    parser.add_argument("--config", type=Path, default=CONFIG_JSON)
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--interval", type=float, default=1)
+    parser.add_argument("--settle", type=float, default=2)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--jobs", type=int, default=0)
+    parser.add_argument("--recursive", action="store_true")
+    args = parser.parse_args(argv)
+
+    watcher = HotFolder(
+        args.folders,
+        args.config,
+        args.output,
+        args.interval,
+        args.settle,
+        args.batch_size,
+        args.jobs,
+        args.recursive,
+    )
+
+    with suppress(KeyboardInterrupt):
+        watcher.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import struct
+from typing import IO
+
+# ImageMagick を起動せずにヘッダだけから画像サイズを読む
+# 対応していない形式や壊れたファイルでは None を返す
+
+
+def read_size_from(fp: IO[bytes]) -> tuple[int, int] | None:
+    head = fp.read(26)
+
+    try:
+        if head.startswith(b"\x89PNG\r\n\x1a\n"):
+            return struct.unpack(">II", head[16:24])
+
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+
+        if head.startswith(b"BM"):
+            if struct.unpack("<I", head[14:18])[0] == 12:
+                return struct.unpack("<HH", head[18:22])
+            width, height = struct.unpack("<ii", head[18:26])
+            return abs(width), abs(height)
+
+        if head.startswith(b"\xff\xd8"):
+            fp.seek(2 - len(head), 1)
+            return _read_jpeg_size(fp)
+
+    except (struct.error, OSError):
+        pass
+
+    return None
+
+
+def _read_jpeg_size(fp: IO[bytes]) -> tuple[int, int] | None:
+    while True:
+        byte = fp.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+
+        marker = fp.read(1)
+        while marker == b"\xff":
+            marker = fp.read(1)
+        if not marker:
+            return None
+
+        code = marker[0]
+
+        # 長さを持たないマーカー
+        if code == 0x01 or 0xD0 <= code <= 0xD9:
+            continue
+
+        (length,) = struct.unpack(">H", fp.read(2))
+
+        # SOF0〜SOF15 (DHT, JPG, DAC を除く)
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            _, height, width = struct.unpack(">BHH", fp.read(5))
+            return width, height
+
+        fp.seek(length - 2, 1)
+
+
+def read_frame_count(fp: IO[bytes]) -> int:
+    # GIF 以外は1枚として扱う
+    try:
+        head = fp.read(13)
+        if head[:6] not in (b"GIF87a", b"GIF89a"):
+            return 1
+        if head[10] & 0x80:
+            fp.seek(3 << ((head[10] & 0x07) + 1), 1)
+
+        frames = 0
+        while block := fp.read(1):
+            if block == b";":
+                break
+
+            if block == b"!":
+                fp.read(1)
+                _skip_sub_blocks(fp)
+
+            elif block == b",":
+                descriptor = fp.read(9)
+                if descriptor[8] & 0x80:
+                    fp.seek(3 << ((descriptor[8] & 0x07) + 1), 1)
+                fp.read(1)
+                _skip_sub_blocks(fp)
+                frames += 1
+
+            else:
+                break
+
+        return max(1, frames)
+
+    except (IndexError, OSError):
+        return 1
+
+
+def _skip_sub_blocks(fp: IO[bytes]) -> None:
+    while (length := fp.read(1)) and length[0]:
+        fp.seek(length[0], 1)
+
+
+def split_images(data: bytes, ext: str) -> list[bytes]:
+    # 複数フレームを標準出力に書き出すと画像がそのまま連結されるので
+    # 形式ごとの構造をたどって1枚ずつに切り分ける
+    images = []
+    start = 0
+
+    while start < len(data):
+        try:
+            if ext == "bmp":
+                (length,) = struct.unpack("<I", data[start + 2 : start + 6])
+                end = start + length
+            elif ext == "png":
+                end = _png_end(data, start)
+            elif ext == "jpg":
+                end = _jpeg_end(data, start)
+            else:
+                end = len(data)
+        except struct.error:
+            end = len(data)
+
+        # 構造をたどれなければ残りをまとめて1枚とする
+        if end <= start:
+            end = len(data)
+        images.append(data[start:end])
+        start = end
+
+    return images
+
+
+def _png_end(data: bytes, start: int) -> int:
+    i = start + 8
+    while i + 8 <= len(data):
+        (length,) = struct.unpack(">I", data[i : i + 4])
+        chunk_type = data[i + 4 : i + 8]
+        i += 12 + length
+        if chunk_type == b"IEND":
+            return i
+    return len(data)
+
+
+def _jpeg_end(data: bytes, start: int) -> int:
+    i = start + 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            # エントロピー符号化データの中の 0xFF は 0x00 か RST が続く
+            i = data.find(b"\xff", i + 1)
+            if i < 0:
+                break
+            continue
+
+        code = data[i + 1]
+        if code == 0xD9:
+            return i + 2
+        if code in (0x00, 0x01, 0xFF) or 0xD0 <= code <= 0xD7:
+            i += 1 if code == 0xFF else 2
+            continue
+
+        (length,) = struct.unpack(">H", data[i + 2 : i + 4])
+        i += 2 + length
+    return len(data)
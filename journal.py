@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from collections.abc import Iterable
+from enum import Enum
+from pathlib import Path
+from typing import Any
+
+import sources
+from constants import JOURNAL_PATH
+
+# 読み込んだ行数が残す記録の数のこの倍を超えたら詰め直す
+COMPACT_RATIO = 2
+
+
+# 出力先ごとに変換済みの (入力, 設定, 出力) を追記していく記録
+# 同じ設定で再実行したとき、入力も出力も記録時から変わっていない
+# ファイルを変換済みとして飛ばせるようにする
+# 出力と一緒に配布されないよう、記録は出力先ではなくキャッシュに置く
+class BatchJournal:
+
+    def __init__(
+        self,
+        output_dir: str | Path,
+        options: dict[str, Any],
+        root: str | Path = JOURNAL_PATH,
+    ):
+        output_dir = Path(output_dir)
+        # 書庫への出力は閉じるときにまとめて置き換えるので途中再開できない
+        self.enabled = output_dir.suffix.lower() != ".zip"
+        name = str(output_dir.resolve()).encode("utf-8")
+        self.path = Path(root) / f"{hashlib.sha1(name).hexdigest()}.jsonl"
+        self.settings = self.fingerprint(options)
+        self.entries: dict[str, dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def fingerprint(options: dict[str, Any]) -> str:
+        data = {
+            key: value.name if isinstance(value, Enum) else value
+            for key, value in options.items()
+        }
+        text = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _load(self) -> None:
+        if not self.enabled or not self.path.is_file():
+            return
+
+        # 入力ごとに最後の記録だけが有効 (設定を変えて変換し直せば
+        # 前の設定の出力は上書きされている)
+        latest: dict[str, str] = {}
+        count = 0
+
+        with open(self.path, "r", encoding="utf-8") as fp:
+            for line in fp:
+                count += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 中断で途切れた最後の行は無視する
+                    continue
+                if not isinstance(entry, dict) or "input" not in entry:
+                    continue
+
+                latest[entry["input"]] = line.rstrip("\n") + "\n"
+                if entry.get("settings") == self.settings:
+                    self.entries[entry["input"]] = entry
+                else:
+                    self.entries.pop(entry["input"], None)
+
+        if count > len(latest) * COMPACT_RATIO:
+            self._compact(latest.values())
+
+    def _compact(self, lines: Iterable[str]) -> None:
+        temp_path = self.path.with_name(f".{self.path.name}.part")
+
+        try:
+            with open(temp_path, "w", encoding="utf-8") as fp:
+                fp.writelines(lines)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(temp_path, self.path)
+        except OSError:
+            # 詰め直せなくても追記はできる
+            pass
+        finally:
+            temp_path.unlink(True)
+
+    def is_done(self, path: str | Path) -> bool:
+        path = Path(path).absolute()
+        entry = self.entries.get(str(path))
+
+        if entry is None or entry.get("source") != sources.stamp(path):
+            return False
+
+        return all(
+            stamp is not None and _stamp(Path(output)) == stamp
+            for output, stamp in entry.get("outputs", {}).items()
+        )
+
+    def record(self, path: str | Path, outputs: Iterable[Path]) -> None:
+        path = Path(path).absolute()
+        outputs = tuple(outputs)
+
+        if not self.enabled or not outputs:
+            return
+
+        entry = {
+            "settings": self.settings,
+            "input": str(path),
+            "source": sources.stamp(path),
+            "outputs": {str(x): _stamp(x) for x in outputs},
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as fp:
+                fp.write(line)
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.entries[entry["input"]] = entry
+
+
+def _stamp(path: Path) -> list[int] | None:
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import os
+import shutil
+import subprocess
+import sys
+from collections.abc import Callable
+from functools import cache
+from pathlib import Path
+from typing import Any
+
+from constants import MAGICK_ENV, MAGICK_PATH
+
+# ImageMagick の実行ファイルの場所と起動方法
+#
+# 環境変数 WIRTHMAGE_MAGICK で指定したもの、同梱版、PATH 上の magick、
+# PATH 上の convert (ImageMagick 6) の順に探し、最初に見つけたものを
+# プロセス内で使い回す。
+#
+# POSIX では posix_spawn (vfork) で起動できるよう、シェルや preexec_fn を
+# 使わず環境変数も毎回組み立てない。CPU時間の上限は起動後に prlimit で
+# 子プロセスに課す (prlimit がない環境だけ preexec_fn を使う)。
+
+# ImageMagick 6 では magick のサブコマンドが別の実行ファイルになっている
+LEGACY_TOOLS = ("compare", "composite", "identify", "mogrify", "montage")
+
+
+@cache
+def locate() -> Path:
+    if path := os.environ.get(MAGICK_ENV):
+        return Path(path)
+
+    for name in ("magick", "magick.exe"):
+        if (path := MAGICK_PATH / name).is_file():
+            return path
+
+    candidates = ["magick"]
+    if sys.platform != "win32":
+        # Windows の convert.exe はファイルシステムの変換ツール
+        candidates.append("convert")
+    for name in candidates:
+        if path := shutil.which(name):
+            return Path(path)
+
+    # 見つからなければ同梱版の場所で起動を試みて FileNotFoundError にする
+    return MAGICK_PATH / "magick"
+
+
+def is_legacy(binary: Path) -> bool:
+    return binary.stem.lower() == "convert"
+
+
+def command(params: tuple[str | Path, ...]) -> tuple[str | Path, ...]:
+    binary = locate()
+
+    if is_legacy(binary) and params and params[0] in LEGACY_TOOLS:
+        return (binary.with_name(str(params[0])), *params[1:])
+
+    return (binary, *params)
+
+
+def spawn_options(cpu_time: int | None) -> dict[str, Any]:
+    # subprocess.Popen と asyncio.create_subprocess_exec に渡す引数
+    if sys.platform == "win32":
+        return {"creationflags": subprocess.CREATE_NO_WINDOW}
+
+    # 継承可能な fd は開いていないので閉じて回る必要はない
+    options: dict[str, Any] = {"close_fds": False}
+    if cpu_time and not _prlimit():
+        options["preexec_fn"] = cpu_time_limiter(cpu_time)
+    return options
+
+
+def limit_process(pid: int, cpu_time: int | None) -> None:
+    # 起動直後の子プロセスに CPU時間の上限を課す
+    if not cpu_time or sys.platform == "win32" or not _prlimit():
+        return
+
+    import resource
+
+    try:
+        resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_time, cpu_time + 1))
+    except (OSError, ValueError):
+        # 既に終了している
+        pass
+
+
+def cpu_time_limiter(cpu_time: int | None) -> Callable[[], None] | None:
+    # CPU時間の上限は POSIX のみ (Windows では経過時間の上限だけが効く)
+    if not cpu_time or sys.platform == "win32":
+        return None
+
+    import resource
+
+    def limit() -> None:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, cpu_time + 1))
+
+    return limit
+
+
+@cache
+def _prlimit() -> bool:
+    if sys.platform == "win32":
+        return False
+
+    import resource
+
+    return hasattr(resource, "prlimit")
@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+# 変換処理の計測値 (カウンタ・ゲージ・ヒストグラム)
+# Prometheus のテキスト形式か JSON のスナップショットで書き出せる
+
+# 秒単位のヒストグラムの既定の区切り
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    items = [f'{k}="{_escape(v)}"' for k, v in labels]
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values: dict[Labels, Any] = {}
+
+    def samples(self) -> list[tuple[str, Labels, float]]:
+        with self.lock:
+            return [(self.name, k, v) for k, v in self.values.items()]
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        with self.lock:
+            return [
+                {"labels": dict(k), "value": v} for k, v in self.values.items()
+            ]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self.lock:
+            self.values[_labels(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: tuple[float, ...] = SECONDS_BUCKETS,
+    ) -> None:
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _labels(labels)
+        with self.lock:
+            if (entry := self.values.get(key)) is None:
+                entry = self.values[key] = {
+                    "counts": [0] * (len(self.buckets) + 1),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            entry["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def time(self, **labels: Any) -> Timer:
+        return Timer(self, labels)
+
+    def samples(self) -> list[tuple[str, Labels, float]]:
+        samples = []
+        with self.lock:
+            for key, entry in self.values.items():
+                total = 0
+                for bound, count in zip(
+                    (*self.buckets, math.inf), entry["counts"]
+                ):
+                    total += count
+                    le = _format_value(bound)
+                    samples.append(
+                        (f"{self.name}_bucket", key + (("le", le),), total)
+                    )
+                samples.append((f"{self.name}_sum", key, entry["sum"]))
+                samples.append((f"{self.name}_count", key, entry["count"]))
+        return samples
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        with self.lock:
+            return [
+                {
+                    "labels": dict(k),
+                    "buckets": dict(
+                        zip(
+                            map(_format_value, (*self.buckets, math.inf)),
+                            v["counts"],
+                        )
+                    ),
+                    "sum": v["sum"],
+                    "count": v["count"],
+                }
+                for k, v in self.values.items()
+            ]
+
+
+class Timer:
+    # with で囲んだ区間の経過時間をヒストグラムに記録する
+
+    def __init__(
+        self,
+        histogram: Histogram,
+        labels: dict[str, Any],
+    ) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> Timer:
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.histogram.observe(
+            time.perf_counter() - self.started, **self.labels
+        )
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls: type, name: str, *args: Any) -> Any:
+        # 同じ名前で何度登録しても同じものを返す
+        with self.lock:
+            if (metric := self.metrics.get(name)) is None:
+                metric = self.metrics[name] = cls(name, *args)
+            return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        buckets: tuple[float, ...] = SECONDS_BUCKETS,
+    ) -> Histogram:
+        return self._get(Histogram, name, help, buckets)
+
+    def prometheus(self) -> str:
+        lines = []
+        for metric in tuple(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {_escape(metric.help)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(
+                    f"{name}{_format_labels(labels)} {_format_value(value)}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "timestamp": time.time(),
+            "metrics": {
+                metric.name: {
+                    "type": metric.type,
+                    "help": metric.help,
+                    "values": metric.snapshot(),
+                }
+                for metric in tuple(self.metrics.values())
+            },
+        }
+
+    def write(self, path: str | Path) -> None:
+        # 拡張子が .json なら JSON、それ以外は Prometheus のテキスト形式
+        # (node_exporter の textfile コレクタが途中を読まないよう置き換える)
+        path = Path(path)
+        if path.suffix.lower() == ".json":
+            text = json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+        else:
+            text = self.prometheus()
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.part")
+        try:
+            temp_path.write_text(text, encoding="utf-8")
+            os.replace(temp_path, path)
+        finally:
+            temp_path.unlink(True)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+write = REGISTRY.write
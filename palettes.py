@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import threading
+import zipfile
+from collections.abc import Iterable
+from pathlib import Path
+
+import sources
+from constants import PALETTE_PATH
+
+# 減色で求めたパレットのディスクキャッシュ
+# 入力の内容のハッシュと、パレットを求めた magick の引数 (色数や
+# リサイズ後のサイズ、ImageMagick のバージョンを含む) のハッシュをキーにし、
+# 同じ入力を同じ設定で変換するときは k-means を省く
+#
+#   palettes/<入力>[:2]/<入力>-<引数>.png   上限を超えたら古いものから消す
+#   palettes/pinned/<入力>-<引数>.png       固定したもの (消さない)
+#
+# export で書き出した ZIP を import すると固定したパレットとして取り込むので、
+# シナリオ単位でパレットを共有して同じ色で変換し直せる
+
+PINNED = "pinned"
+
+
+class PaletteStore:
+
+    def __init__(self, root: str | Path, capacity: int = 16384) -> None:
+        self.root = Path(root)
+        self.pinned_dir = self.root / PINNED
+        self.capacity = capacity
+        self.count = -1
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha1(data).hexdigest()
+
+    def key(self, data: bytes, params: Iterable[str | Path]) -> str:
+        text = "\0".join(map(str, params))
+        params_digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return f"{self.digest(data)}-{params_digest[:16]}"
+
+    def path_for(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.png"
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            return (self.pinned_dir / f"{key}.png").read_bytes()
+        except OSError:
+            pass
+
+        path = self.path_for(key)
+        try:
+            data = path.read_bytes()
+            # 更新日時を最終使用日時として使う
+            os.utime(path)
+        except OSError:
+            return None
+
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        try:
+            _write(self.path_for(key), data)
+        except OSError:
+            return
+        self._evict()
+
+    def pin(self, digests: Iterable[str]) -> int:
+        # 指定した入力のキャッシュ済みパレットを固定する
+        count = 0
+        self.pinned_dir.mkdir(parents=True, exist_ok=True)
+
+        for digest in set(digests):
+            for path in (self.root / digest[:2]).glob(f"{digest}-*.png"):
+                try:
+                    os.replace(path, self.pinned_dir / path.name)
+                except OSError:
+                    continue
+                count += 1
+
+        return count
+
+    def export(
+        self,
+        archive: str | Path,
+        digests: Iterable[str] | None = None,
+    ) -> int:
+        # digests を指定しなければ固定したものとキャッシュをすべて書き出す
+        wanted = None if digests is None else set(digests)
+        names: set[str] = set()
+        archive = Path(archive)
+        archive.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = archive.with_name(f".{archive.name}.part")
+
+        try:
+            with zipfile.ZipFile(temp_path, "w") as zf:
+                for path in (
+                    *self.pinned_dir.glob("*.png"),
+                    *self.root.glob("[0-9a-f][0-9a-f]/*.png"),
+                ):
+                    digest = path.stem.partition("-")[0]
+                    if wanted is not None and digest not in wanted:
+                        continue
+                    if path.name in names:
+                        continue
+                    try:
+                        zf.writestr(path.name, path.read_bytes())
+                    except OSError:
+                        continue
+                    names.add(path.name)
+            os.replace(temp_path, archive)
+        finally:
+            temp_path.unlink(True)
+
+        return len(names)
+
+    def import_(self, archive: str | Path) -> int:
+        count = 0
+
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                name = Path(info.filename).name
+                if info.is_dir() or not name.endswith(".png"):
+                    continue
+                _write(self.pinned_dir / name, zf.read(info))
+                count += 1
+
+        return count
+
+    def _evict(self) -> None:
+        with self.lock:
+            if self.count < 0:
+                self.count = sum(1 for _ in self._entries())
+            else:
+                self.count += 1
+            if self.count <= self.capacity:
+                return
+            self.count = -1
+
+        # 毎回数え直さないよう上限の1割余分に消す
+        entries = []
+        for entry in self._entries():
+            try:
+                entries.append((entry.stat().st_mtime_ns, entry))
+            except OSError:
+                pass
+
+        entries.sort()
+        for _, entry in entries[: len(entries) - self.capacity * 9 // 10]:
+            entry.unlink(True)
+
+    def _entries(self) -> Iterable[Path]:
+        return self.root.glob("[0-9a-f][0-9a-f]/*.png")
+
+
+def _write(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f".{path.name}.{threading.get_ident()}.part")
+    try:
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(True)
+
+
+_default: PaletteStore | None = None
+_lock = threading.Lock()
+
+
+def default_store() -> PaletteStore:
+    global _default
+
+    with _lock:
+        if _default is None:
+            _default = PaletteStore(PALETTE_PATH)
+        return _default
+
+
+def _digests(paths: Iterable[Path]) -> list[str]:
+    digests = []
+    for path in paths:
+        for item in sources.iter_inputs(path):
+            digests.append(PaletteStore.digest(sources.read_bytes(item)))
+    return digests
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="WirthMage --palettes")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export")
+    export.add_argument("archive", type=Path)
+    export.add_argument("inputs", type=Path, nargs="*")
+
+    import_ = commands.add_parser("import")
+    import_.add_argument("archive", type=Path)
+
+    pin = commands.add_parser("pin")
+    pin.add_argument("inputs", type=Path, nargs="+")
+
+    args = parser.parse_args(argv)
+    store = default_store()
+
+    if args.command == "export":
+        digests = _digests(args.inputs) if args.inputs else None
+        print(store.export(args.archive, digests))
+
+    elif args.command == "import":
+        print(store.import_(args.archive))
+
+    elif args.command == "pin":
+        print(store.pin(_digests(args.inputs)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from constants import (
+    AnimationMode,
+    DitherMethod,
+    ImageSize,
+    ImageType,
+    IndexedColor,
+    OutlineStyle,
+    Quality,
+)
+from converter import ConversionError, convert_bytes, magick, output_name
+
+# 変換結果が最適化の前後で変わっていないかを確かめる回帰チェック
+# 合成した入力と基準の出力を record で保存し、check で現在の実装の出力と
+# PSNR・SSIM・パレットの色差で比べる (バイト単位の一致は求めない)
+#
+#   python regression.py record golden/
+#   python regression.py check golden/
+
+# 入力画像を合成する magick の引数 (出力先は標準出力)
+CORPUS: dict[str, tuple[str, ...]] = {
+    "gradient.png": ("-size", "640x480", "gradient:#2040c0-#f0c020"),
+    "plasma.png": ("-seed", "1", "-size", "640x480", "plasma:"),
+    "checker.png": (
+        "-size",
+        "320x240",
+        "pattern:checkerboard",
+        "-scale",
+        "200%",
+    ),
+    "sprite.bmp": (
+        "-size",
+        "160x200",
+        "xc:#ff00ff",
+        "-fill",
+        "#3080c0",
+        "-draw",
+        "circle 80,100 80,20",
+        "-fill",
+        "#f0f0f0",
+        "-draw",
+        "rectangle 60,60 100,140",
+    ),
+    "photo.jpg": (
+        "-seed",
+        "2",
+        "-size",
+        "800x600",
+        "plasma:#204080-#e0a060",
+        "-blur",
+        "0x2",
+        "-quality",
+        "90",
+    ),
+    # フレームごとに色合いの違うアニメーションGIF
+    "anim.gif": (
+        "-seed",
+        "3",
+        "-delay",
+        "10",
+        "-size",
+        "240x180",
+        "gradient:#c02020-#2020c0",
+        "gradient:#20c020-#f0f040",
+        "plasma:",
+        "-loop",
+        "0",
+    ),
+}
+
+# 主要な設定の組み合わせ
+CASES: dict[str, dict[str, Any]] = {
+    "asis-bmp": {},
+    "card-png-x2": {
+        "image_size": ImageSize.CARD,
+        "output_x2": True,
+        "image_type": ImageType.PNG,
+    },
+    "yado-256": {
+        "image_size": ImageSize.YADO,
+        "indexed_color": IndexedColor.INDEXED_8BIT,
+    },
+    "card-16-outline": {
+        "image_size": ImageSize.CARD,
+        "indexed_color": IndexedColor.INDEXED_4BIT,
+        "color_mask": True,
+        "outline_style": OutlineStyle.INNER_BLACK_OUTER_WHITE,
+    },
+    "card-16-ordered": {
+        "image_size": ImageSize.CARD,
+        "indexed_color": IndexedColor.INDEXED_4BIT,
+        "dither_method": DitherMethod.ORDERED_8X8,
+    },
+    "full-jpeg": {
+        "image_size": ImageSize.FULL,
+        "image_type": ImageType.JPEG,
+    },
+    "draft-64": {
+        "indexed_color": IndexedColor.INDEXED_6BIT,
+        "quality": Quality.DRAFT,
+    },
+    "yado-auto": {
+        "image_size": ImageSize.YADO,
+        "indexed_color": IndexedColor.AUTO,
+    },
+    "card-frames-32": {
+        "image_size": ImageSize.CARD,
+        "indexed_color": IndexedColor.INDEXED_5BIT,
+        "animation_mode": AnimationMode.ALL_FRAMES,
+    },
+    "card-sheet-png": {
+        "image_size": ImageSize.CARD,
+        "image_type": ImageType.PNG,
+        "animation_mode": AnimationMode.SPRITE_SHEET,
+    },
+    "full-jpeg-30k": {
+        "image_size": ImageSize.FULL,
+        "image_type": ImageType.JPEG,
+        "jpeg_max_size": 30000,
+    },
+}
+
+MANIFEST_NAME = "manifest.json"
+
+
+class Thresholds(NamedTuple):
+    psnr: float = 35.0
+    ssim: float = 0.97
+    # パレットの各色から相手側の最も近い色までの RGB 距離の平均 (0〜441)
+    palette: float = 8.0
+
+
+class Result(NamedTuple):
+    case: str
+    name: str
+    psnr: float
+    ssim: float
+    palette: float | None
+    error: str = ""
+
+    def passed(self, thresholds: Thresholds) -> bool:
+        return (
+            not self.error
+            and self.psnr >= thresholds.psnr
+            and self.ssim >= thresholds.ssim
+            and (self.palette is None or self.palette <= thresholds.palette)
+        )
+
+
+def generate_corpus(corpus_dir: Path) -> list[Path]:
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+
+    for name, params in CORPUS.items():
+        path = corpus_dir / name
+        kind = path.suffix[1:].upper().replace("JPG", "JPEG")
+        result = magick(*params, "-strip", f"{kind}:-")
+        if result.returncode != 0:
+            raise ConversionError(result.returncode, result.stderr)
+        path.write_bytes(result.stdout)
+        paths.append(path)
+
+    return paths
+
+
+def run_case(
+    paths: list[Path],
+    options: dict[str, Any],
+    repeat: int = 1,
+) -> tuple[dict[str, bytes], float]:
+    # 出力ファイル名ごとの出力と、全入力の変換時間 (repeat 回の最短)
+    # パレットも毎回求め直して、減色の変更を比較できるようにする
+    options = {**options, "palette_cache": False}
+    outputs: dict[str, bytes] = {}
+    best = math.inf
+
+    for _ in range(max(1, repeat)):
+        started = time.perf_counter()
+        for path in paths:
+            images = convert_bytes(path.read_bytes(), **options)
+            image_type = options.get("image_type", ImageType.BMP)
+            for x, data in images.items():
+                if isinstance(data, bytes):
+                    outputs[output_name(path, x, image_type)] = data
+                else:
+                    for i, frame in enumerate(data, 1):
+                        name = output_name(path, x, image_type, i)
+                        outputs[name] = frame
+        best = min(best, time.perf_counter() - started)
+
+    return outputs, best
+
+
+def record(root: Path, repeat: int = 1) -> None:
+    paths = generate_corpus(root / "corpus")
+    timings = {}
+
+    for case, options in CASES.items():
+        outputs, seconds = run_case(paths, options, repeat)
+        case_dir = root / "reference" / case
+        case_dir.mkdir(parents=True, exist_ok=True)
+        for name, data in outputs.items():
+            (case_dir / name).write_bytes(data)
+        timings[case] = seconds
+        print(f"{case:<20} {seconds:8.3f}s  {len(outputs)} files")
+
+    manifest = {
+        "version": magick("-version").stdout.decode().splitlines()[0],
+        "timings": timings,
+    }
+    (root / MANIFEST_NAME).write_text(
+        json.dumps(manifest, ensure_ascii=False, indent=4), encoding="utf-8"
+    )
+
+
+def check(
+    root: Path,
+    thresholds: Thresholds = Thresholds(),
+    repeat: int = 1,
+) -> bool:
+    manifest = json.loads((root / MANIFEST_NAME).read_text(encoding="utf-8"))
+    paths = sorted((root / "corpus").iterdir())
+    ok = True
+
+    print(f"{'case':<20} {'file':<24} {'PSNR':>7} {'SSIM':>7} {'palette':>8}")
+
+    for case, options in CASES.items():
+        outputs, seconds = run_case(paths, options, repeat)
+        case_dir = root / "reference" / case
+
+        for reference in sorted(case_dir.iterdir()):
+            data = outputs.pop(reference.name, None)
+            result = compare(case, reference, data)
+            passed = result.passed(thresholds)
+            ok = ok and passed
+            palette = "-"
+            if result.palette is not None:
+                palette = f"{result.palette:.2f}"
+            print(
+                f"{case:<20} {reference.name:<24}"
+                f" {result.psnr:7.2f} {result.ssim:7.4f} {palette:>8}"
+                f"  {'ok' if passed else 'NG ' + result.error}"
+            )
+
+        for name in outputs:
+            ok = False
+            print(f"{case:<20} {name:<24} NG 基準にない出力")
+
+        before = manifest.get("timings", {}).get(case)
+        if before:
+            change = (seconds - before) / before * 100
+            print(
+                f"{case:<20} 時間 {before:.3f}s -> {seconds:.3f}s"
+                f" ({change:+.1f}%)"
+            )
+
+    return ok
+
+
+def compare(case: str, reference: Path, data: bytes | None) -> Result:
+    name = reference.name
+
+    if data is None:
+        return Result(case, name, 0.0, 0.0, None, "出力されなかった")
+
+    # 完全に一致する場合の PSNR の表記はバージョンで異なるので先に確かめる
+    if _metric("AE", reference, data) == 0:
+        psnr, ssim = math.inf, 1.0
+    else:
+        psnr = _metric("PSNR", reference, data)
+        ssim = _metric("SSIM", reference, data)
+    if psnr is None or ssim is None:
+        return Result(case, name, 0.0, 0.0, None, "比較できない")
+
+    palette = None
+    before, after = _palette(reference.read_bytes()), _palette(data)
+    # 256色以下ならインデックスカラーとしてパレットも比べる
+    if 0 < len(before) <= 256 and 0 < len(after) <= 256:
+        palette = max(
+            _palette_distance(before, after),
+            _palette_distance(after, before),
+        )
+
+    return Result(case, name, psnr, ssim, palette)
+
+
+def _metric(metric: str, reference: Path, data: bytes) -> float | None:
+    # compare は差があると終了コード 1 を返し、値は標準エラーに出る
+    result = magick(
+        "compare", "-metric", metric, reference, "-", "null:", input=data
+    )
+    if result.returncode > 1:
+        return None
+
+    text = result.stderr.decode("utf-8", "replace").strip()
+    if text.startswith("inf"):
+        return math.inf
+    if match := re.match(r"[-+0-9.e]+", text):
+        return float(match[0])
+    return None
+
+
+def _palette(data: bytes) -> list[tuple[int, int, int]]:
+    result = magick(
+        "-",
+        "-alpha",
+        "off",
+        "-unique-colors",
+        "-depth",
+        "8",
+        "txt:-",
+        input=data,
+    )
+    return [
+        (int(x[0:2], 16), int(x[2:4], 16), int(x[4:6], 16))
+        for x in re.findall(r"#([0-9A-Fa-f]{6})", result.stdout.decode())
+    ]
+
+
+def _palette_distance(
+    source: list[tuple[int, int, int]],
+    target: list[tuple[int, int, int]],
+) -> float:
+    total = sum(min(math.dist(a, b) for b in target) for a in source)
+    return total / len(source)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="regression.py")
+    parser.add_argument("command", choices=("record", "check"))
+    parser.add_argument("root", type=Path)
+    defaults = Thresholds()
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--psnr", type=float, default=defaults.psnr)
+    parser.add_argument("--ssim", type=float, default=defaults.ssim)
+    parser.add_argument("--palette", type=float, default=defaults.palette)
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        record(args.root, args.repeat)
+        return
+
+    thresholds = Thresholds(args.psnr, args.ssim, args.palette)
+    if not check(args.root, thresholds, args.repeat):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
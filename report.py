@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import subprocess
+import threading
+from pathlib import Path
+
+from constants import REPORT_NAME
+from converter import ConversionError, FallbackWarning
+
+
+class FailureReport:
+    # 変換に失敗したファイルを集めて出力先に書き出す
+
+    def __init__(self) -> None:
+        self.failures: list[tuple[Path, BaseException]] = []
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.failures)
+
+    def add(self, path: str | Path, error: BaseException) -> None:
+        with self.lock:
+            self.failures.append((Path(path), error))
+
+    @staticmethod
+    def path_for(output_dir: str | Path) -> Path:
+        # 出力と一緒に配布されないよう、出力先の中ではなく隣に置く
+        output_dir = Path(output_dir)
+        name = output_dir.stem if output_dir.suffix.lower() == ".zip" else None
+        return output_dir.with_name(f"{name or output_dir.name}-{REPORT_NAME}")
+
+    def save(self, output_dir: str | Path) -> Path | None:
+        path = self.path_for(output_dir)
+
+        # 失敗がなければ前回の報告が残って紛らわしくならないよう消す
+        if not self.failures:
+            path.unlink(True)
+            return None
+
+        with self.lock:
+            lines = []
+            for source, error in self.failures:
+                lines.append(str(source))
+                lines.extend(f"    {x}" for x in describe(error).splitlines())
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        return path
+
+
+def describe(error: BaseException) -> str:
+    if isinstance(error, FallbackWarning):
+        return f"軽い設定で変換しました\n{describe(error.error)}"
+    if isinstance(error, subprocess.TimeoutExpired):
+        return f"時間切れ ({error.timeout:g}秒)"
+    if isinstance(error, ConversionError):
+        return f"ImageMagick エラー ({error.returncode})\n{error.stderr}"
+    if isinstance(error, FileNotFoundError):
+        return "ファイルが見つかりません"
+    return repr(error)
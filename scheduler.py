@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import math
+import os
+import sys
+import threading
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any
+
+import capabilities
+import sources
+from constants import (
+    AnimationMode,
+    DitherMethod,
+    ImageSize,
+    ImageType,
+    IndexedColor,
+    OutlineStyle,
+    Quality,
+)
+from converter import DimensionPreset
+from image_header import read_frame_count, read_size_from
+
+# プロセス起動や identify など画素数によらない固定費の目安
+STARTUP_COST = 0x10000
+
+
+def default_workers() -> int:
+    # ImageMagick 自体も OpenMP で並列化する場合は論理コア数の半分を上限にする
+    cpus = os.cpu_count() or 1
+    if not capabilities.current().openmp:
+        return cpus
+    return max(1, cpus // 2)
+
+
+def thread_limit(workers: int) -> int:
+    # 同時に動くプロセスのスレッド数の合計が論理コア数
+    # (ImageMagick のスレッド数の上限の方が小さければそれ) を超えないようにする
+    # 0 なら制限しない
+    current = capabilities.current()
+    if not current.openmp:
+        return 0
+    threads = os.cpu_count() or 1
+    if current.threads:
+        threads = min(threads, current.threads)
+    return max(1, threads // max(1, workers))
+
+
+def physical_memory() -> int:
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [
+                ("dwLength", wintypes.DWORD),
+                ("dwMemoryLoad", wintypes.DWORD),
+                ("ullTotalPhys", ctypes.c_uint64),
+                ("ullAvailPhys", ctypes.c_uint64),
+                ("ullTotalPageFile", ctypes.c_uint64),
+                ("ullAvailPageFile", ctypes.c_uint64),
+                ("ullTotalVirtual", ctypes.c_uint64),
+                ("ullAvailVirtual", ctypes.c_uint64),
+                ("ullAvailExtendedVirtual", ctypes.c_uint64),
+            ]
+
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys
+        return 0
+
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def default_memory_budget() -> int:
+    # 物理メモリの半分 (取得できなければ 2GiB)
+    return physical_memory() // 2 or 2 << 30
+
+
+class MemoryBudget:
+    # 同時実行中のジョブの推定メモリ合計が予算内に収まるときだけ実行を許可する
+
+    def __init__(self, total: int = 0) -> None:
+        self.total = total or default_memory_budget()
+        self.used = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, amount: int) -> Iterator[int]:
+        # 戻り値はそのジョブに課すメモリ上限 (0 なら制限なし)
+        reserved, limit = self.acquire(amount)
+        try:
+            yield limit
+        finally:
+            self.release(reserved)
+
+    def acquire(self, amount: int) -> tuple[int, int]:
+        # 単独でも予算を超えるジョブは他が終わるのを待ち、
+        # 予算全体を確保したうえで -limit で上限を抑えて実行させる
+        # 戻り値は (確保した量, そのジョブに課すメモリ上限)
+        # with で囲めない場合 (イベントループから別スレッドで待つなど) 用
+        amount = max(0, amount)
+        reserved = min(amount, self.total)
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.used + reserved <= self.total)
+            self.used += reserved
+
+        return reserved, self.total if amount > self.total else 0
+
+    def release(self, reserved: int) -> None:
+        with self.condition:
+            self.used -= reserved
+            self.condition.notify_all()
+
+
+def estimate_cost(path: str | Path, options: dict[str, Any]) -> float:
+    if (shape := _job_shape(path, options)) is None:
+        return 0.0
+
+    source_pixels, output_sizes, colors, outlines, sample = shape
+    diffusion = DitherMethod(
+        options.get("dither_method", DitherMethod.FLOYD_STEINBERG)
+    ).error_diffusion
+    cost = float(STARTUP_COST)
+
+    for output_pixels in output_sizes:
+        # 読み込みとリサイズは出力ごとに行う
+        cost += STARTUP_COST + source_pixels + output_pixels
+        if outlines:
+            # マスクの取り出しと合成、縁ごとのモルフォロジーと着色
+            # モルフォロジーは太さに比例して重くなる
+            width = options.get("outline_width", 1)
+            cost += output_pixels * (2 + outlines * (3 + width))
+
+        if colors:
+            # 中間画像を書き出し、パレットを求める処理と仕上げの処理が
+            # それぞれ読み直す
+            sample_pixels = min(output_pixels, sample)
+            cost += STARTUP_COST * 2 + output_pixels * 3
+            cost += sample_pixels * (4 + math.log2(colors))
+            # 誤差拡散は逐次処理なので組織的ディザより重い
+            cost += output_pixels * (3 if diffusion else 1)
+
+        if options.get("image_type") == ImageType.JPEG and (
+            options.get("jpeg_max_size") or options.get("jpeg_bytes_per_pixel")
+        ):
+            # 収まらなければ画質を変えて最大8回ほど符号化し直す
+            cost += (STARTUP_COST + output_pixels) * 4
+
+    return cost
+
+
+def estimate_memory(path: str | Path, options: dict[str, Any]) -> int:
+    if (shape := _job_shape(path, options)) is None:
+        return 0
+
+    source_pixels, output_sizes, colors, outlines, sample = shape
+    bytes_per_pixel = capabilities.current().bytes_per_pixel
+    peak = 0
+
+    # 出力サイズごとに別プロセスで順に実行するので最大値がピーク
+    for output_pixels in output_sizes:
+        # 読み込んだ元画像とリサイズ後の画像
+        pixels = source_pixels * 2 + output_pixels
+        # mpr:base と縁取り用のマスク・塗り色の層
+        pixels += output_pixels * (1 + bool(outlines) + outlines * 2)
+        if colors:
+            # 減色用の縮小画像と -remap 用の複製
+            pixels += min(source_pixels, sample) * 2 + output_pixels
+        peak = max(peak, pixels * bytes_per_pixel)
+
+    return peak
+
+
+def _job_shape(
+    path: str | Path,
+    options: dict[str, Any],
+) -> tuple[int, list[int], int, int, int] | None:
+
+    animation_mode = AnimationMode(
+        options.get("animation_mode", AnimationMode.FIRST_FRAME)
+    )
+
+    try:
+        with sources.open_input(path) as fp:
+            size = read_size_from(fp)
+            frames = 1
+            if animation_mode != AnimationMode.FIRST_FRAME:
+                fp.seek(0)
+                frames = read_frame_count(fp)
+    except (OSError, KeyError):
+        return None
+
+    if size:
+        source_pixels = size[0] * size[1]
+    elif stamp := sources.stamp(path):
+        # ヘッダを読めない場合はファイルサイズで代用
+        source_pixels = stamp[0]
+    else:
+        return None
+
+    target_size = DimensionPreset.of(options.get("image_size", ImageSize.ASIS))
+    colors = IndexedColor(
+        options.get("indexed_color", IndexedColor.NONE)
+    ).number
+    outline_style = OutlineStyle(
+        options.get("outline_style", OutlineStyle.NONE)
+    )
+    outlines = 0
+    if options.get("color_mask"):
+        outlines = (outline_style.inner is not None) + (
+            outline_style.outer is not None
+        )
+
+    scales = [1]
+    if target_size:
+        if options.get("output_x2"):
+            scales.append(2)
+        if options.get("output_x4"):
+            scales.append(4)
+
+    output_sizes = [
+        target_size.scale(x).pixels if target_size else source_pixels
+        for x in scales
+    ]
+
+    # 複数フレームは全フレームを同じプロセスで順に処理する
+    source_pixels *= frames
+    output_sizes = [pixels * frames for pixels in output_sizes]
+
+    quality = Quality(options.get("quality", Quality.STANDARD))
+    sample = quality.params.kmeans_sample
+
+    return source_pixels, output_sizes, colors, outlines, sample
+
+
+def apply_budget(
+    paths: Iterable[str | Path],
+    options: dict[str, Any],
+    budget: int,
+) -> dict[str, Any]:
+    # バッチ全体の JPEG の出力サイズの予算 (バイト) を
+    # 出力の画素数に比例して割り振るよう、1画素あたりの上限を設定する
+    if not budget or options.get("image_type") != ImageType.JPEG:
+        return options
+
+    pixels = 0
+    for path in paths:
+        if (shape := _job_shape(path, options)) is not None:
+            pixels += sum(shape[1])
+
+    if not pixels:
+        return options
+
+    return {**options, "jpeg_bytes_per_pixel": budget / pixels}
+
+
+def order_by_cost(
+    paths: Iterable[str | Path],
+    options: dict[str, Any],
+) -> list[Path]:
+    # 重いジョブから順に流せば、共有キューから取り出すワーカ群は
+    # LPT (Longest Processing Time first) の貪欲割り当てになる
+    costs = estimate_costs(paths, options)
+    return sorted(costs, key=costs.__getitem__, reverse=True)
+
+
+def estimate_costs(
+    paths: Iterable[str | Path],
+    options: dict[str, Any],
+) -> dict[Path, float]:
+    return {Path(path): estimate_cost(path, options) for path in paths}
@@ -0,0 +1,310 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import socket
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import suppress
+from pathlib import Path
+from typing import Any
+
+import capabilities
+import metrics
+from constants import SERVER_HOST, SERVER_LINE_LIMIT, SERVER_PORT
+from converter import QUEUE_DEPTH, FallbackWarning
+from converter_async import convert_async
+from converter_params import ConverterParams
+from scheduler import (
+    MemoryBudget,
+    apply_budget,
+    default_workers,
+    estimate_memory,
+    order_by_cost,
+    thread_limit,
+)
+from sinks import OutputSink, SharedSinks
+
+Reply = Callable[[dict[str, Any]], Awaitable[None]]
+
+
+class Job:
+
+    def __init__(
+        self,
+        id: Any,
+        path: Path,
+        sink: OutputSink,
+        options: dict[str, Any],
+        limits: dict[str, Any],
+        reply: Reply,
+    ) -> None:
+
+        self.id = id
+        self.path = path
+        self.sink = sink
+        self.options = options
+        self.limits = limits
+        self.reply = reply
+        self.queued_at = time.perf_counter()
+        self.done = asyncio.get_running_loop().create_future()
+
+
+# 1行1件の JSON でジョブを受け付ける常駐変換サーバ
+# リクエストは config.json と同じ形式で、input_files の各ファイルが
+# 1件のジョブになる。結果はジョブごとに完了順で1行ずつ返す。
+class ConversionServer:
+
+    def __init__(
+        self,
+        host: str = SERVER_HOST,
+        port: int = SERVER_PORT,
+        workers: int = 0,
+        timeout: float | None = None,
+        metrics_file: str | Path | None = None,
+        metrics_interval: float = 15,
+        memory_budget: int = 0,
+    ) -> None:
+
+        # workers が 0 なら ImageMagick の並列化に合わせて決める
+        self.host = host
+        self.port = port
+        self.workers = max(0, workers)
+        self.timeout = timeout
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        # 同じ出力先へのリクエストは接続をまたいで1つの出力を共有する
+        self.sinks = SharedSinks()
+        # 同時に変換するジョブの推定メモリの合計 (MiB, 0 で物理メモリの半分)
+        self.budget = MemoryBudget(memory_budget << 20)
+
+    async def serve(self) -> None:
+        self.queue: asyncio.Queue[Job] = asyncio.Queue()
+
+        # ImageMagick の機能の確認 (初回は magick を何度か起動する) を
+        # 受け付け前にイベントループの外で済ませておく
+        await asyncio.to_thread(capabilities.current)
+        self.workers = self.workers or default_workers()
+        self.threads = thread_limit(self.workers)
+
+        workers = [
+            asyncio.create_task(self._work()) for _ in range(self.workers)
+        ]
+        if self.metrics_file:
+            workers.append(asyncio.create_task(self._export()))
+        server = await asyncio.start_server(
+            self._handle, self.host, self.port, limit=SERVER_LINE_LIMIT
+        )
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if self.metrics_file:
+                metrics.write(self.metrics_file)
+
+    async def _export(self) -> None:
+        # 計測値を一定間隔で書き出す (textfile コレクタなどで収集する)
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            metrics.write(self.metrics_file)
+
+    async def _handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+
+        lock = asyncio.Lock()
+        pending: list[asyncio.Future[None]] = []
+        sinks: list[OutputSink] = []
+
+        async def reply(message: dict[str, Any]) -> None:
+            data = json.dumps(message, ensure_ascii=False).encode("utf-8")
+            async with lock:
+                writer.write(data + b"\n")
+                await writer.drain()
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError as e:
+                    # 1行が上限を超えた (続きを読み捨てられないので打ち切る)
+                    await reply({"status": "error", "error": repr(e)})
+                    break
+
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+
+                try:
+                    sink, jobs = await self._parse(line, reply)
+                except Exception as e:
+                    await reply({"status": "error", "error": repr(e)})
+                    continue
+
+                sinks.append(sink)
+
+                for job in jobs:
+                    self.queue.put_nowait(job)
+                    QUEUE_DEPTH.set(self.queue.qsize())
+                    pending.append(job.done)
+                    await reply(
+                        {
+                            "id": job.id,
+                            "path": str(job.path),
+                            "status": "queued",
+                            "queue_depth": self.queue.qsize(),
+                        }
+                    )
+
+            await asyncio.gather(*pending)
+
+        except ConnectionError:
+            pass
+
+        finally:
+            # 切断されたクライアントの未処理ジョブは実行しない
+            for future in pending:
+                future.cancel()
+            for sink in sinks:
+                # 書庫の出力は閉じるときにまとめて書き出すので別スレッドで
+                await asyncio.to_thread(self.sinks.release, sink)
+            writer.close()
+            with suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def _parse(
+        self,
+        line: bytes,
+        reply: Reply,
+    ) -> tuple[OutputSink, list[Job]]:
+
+        data = json.loads(line)
+        params = ConverterParams()
+        params.update(data)
+        paths = tuple(params.input_files.values())
+        # 予算の割り振りと並べ替えは各入力のヘッダを読むので
+        # イベントループの外で行う
+        options = await asyncio.to_thread(
+            apply_budget, paths, params.options(), params.jpeg_budget
+        )
+        paths = await asyncio.to_thread(order_by_cost, paths, options)
+        options = {
+            **options,
+            "thread_limit": self.threads,
+            "palette_cache": True,
+        }
+        limits = params.job_limits()
+        if self.timeout:
+            limits["timeout"] = self.timeout
+        sink = self.sinks.acquire(params.output_dir)
+
+        return sink, [
+            Job(data.get("id"), path, sink, options, limits, reply)
+            for path in paths
+        ]
+
+    async def _work(self) -> None:
+        while True:
+            job = await self.queue.get()
+            QUEUE_DEPTH.set(self.queue.qsize())
+            try:
+                if not job.done.done():
+                    await self._run(job)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, job: Job) -> None:
+        message: dict[str, Any] = {"id": job.id, "path": str(job.path)}
+
+        # 推定メモリが予算に収まるまで別スレッドで待つ
+        # (同時に待つのはワーカの数までに限られる)
+        reserved, memory_limit = await asyncio.to_thread(
+            lambda: self.budget.acquire(estimate_memory(job.path, job.options))
+        )
+        started = time.perf_counter()
+
+        try:
+            outputs = await convert_async(
+                job.path,
+                job.sink,
+                memory_limit=memory_limit,
+                **job.limits,
+                **job.options,
+            )
+        except FallbackWarning as e:
+            message["status"] = "done"
+            message["warning"] = repr(e.error)
+            message["outputs"] = [str(x) for x in e.outputs]
+        except Exception as e:
+            message["status"] = "failed"
+            message["error"] = repr(e)
+        else:
+            message["status"] = "done"
+            message["outputs"] = [str(x) for x in outputs]
+        finally:
+            self.budget.release(reserved)
+
+        finished = time.perf_counter()
+        message["metrics"] = {
+            "wait_seconds": round(started - job.queued_at, 6),
+            "run_seconds": round(finished - started, 6),
+            "queue_depth": self.queue.qsize(),
+        }
+
+        with suppress(ConnectionError):
+            await job.reply(message)
+
+        if not job.done.done():
+            job.done.set_result(None)
+
+
+def submit(
+    request: dict[str, Any],
+    host: str = SERVER_HOST,
+    port: int = SERVER_PORT,
+) -> Iterator[dict[str, Any]]:
+    with socket.create_connection((host, port)) as sock:
+        data = json.dumps(request, ensure_ascii=False).encode("utf-8")
+        sock.sendall(data + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+
+        with sock.makefile("rb") as fp:
+            for line in fp:
+                yield json.loads(line)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="WirthMage --serve")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=None)
+    parser.add_argument("--metrics", default=None)
+    parser.add_argument("--metrics-interval", type=float, default=15)
+    parser.add_argument("--memory-budget", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = ConversionServer(
+        args.host,
+        args.port,
+        args.workers,
+        args.timeout,
+        args.metrics,
+        args.metrics_interval,
+        args.memory_budget,
+    )
+
+    with suppress(KeyboardInterrupt):
+        asyncio.run(server.serve())
+
+
+if __name__ == "__main__":
+    main()
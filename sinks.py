@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import os
+import threading
+import warnings
+import zipfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+# 変換結果の書き出し先
+
+
+class OutputSink:
+
+    def write(self, name: str, data: bytes) -> Path:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> OutputSink:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # 中断されても書き終えた分はフォルダ出力と同様に残す
+        self.close()
+
+
+class FolderSink(OutputSink):
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def write(self, name: str, data: bytes) -> Path:
+        # 書きかけのファイルが完成品に見えないよう
+        # 一時ファイルに書き出してから置き換える
+        path = self.root / name
+        temp_path = self.root / f".{name}.part"
+
+        try:
+            temp_path.write_bytes(data)
+            os.replace(temp_path, path)
+        finally:
+            temp_path.unlink(True)
+
+        return path
+
+
+class ZipSink(OutputSink):
+
+    def __init__(self, archive: str | Path) -> None:
+        self.archive = Path(archive)
+        self.archive.parent.mkdir(parents=True, exist_ok=True)
+        self.temp_path = self.archive.with_name(f".{self.archive.name}.part")
+        self.zip: zipfile.ZipFile | None = zipfile.ZipFile(self.temp_path, "w")
+        self.names: set[str] = set()
+        # 同じ名前を2回以上書いたか (閉じるときに最後のものだけ残す)
+        self.duplicated = False
+        self.lock = threading.Lock()
+
+    def write(self, name: str, data: bytes) -> Path:
+        # 圧縮済みの形式はそのまま格納する
+        compress_type = (
+            zipfile.ZIP_DEFLATED
+            if name.lower().endswith(".bmp")
+            else zipfile.ZIP_STORED
+        )
+
+        with self.lock:
+            if self.zip is None:
+                raise ValueError("archive is closed")
+            # フォルダ出力と同じく後から書いたものを残す
+            # 書庫には追記しかできないので、重複は閉じるときに除く
+            if name in self.names:
+                self.duplicated = True
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", "Duplicate name")
+                self.zip.writestr(name, data, compress_type)
+            self.names.add(name)
+
+        return self.archive / name
+
+    def close(self) -> None:
+        with self.lock:
+            if self.zip is None:
+                return
+
+            try:
+                if self.archive.is_file():
+                    # 今回出力しなかった既存のエントリを引き継ぐ
+                    with zipfile.ZipFile(self.archive) as old:
+                        for info in old.infolist():
+                            if info.filename not in self.names:
+                                self.zip.writestr(info, old.read(info))
+            finally:
+                self.zip.close()
+                self.zip = None
+
+            if self.duplicated:
+                self._drop_duplicates()
+
+            os.replace(self.temp_path, self.archive)
+
+    def _drop_duplicates(self) -> None:
+        temp_path = self.temp_path.with_name(f"{self.temp_path.name}~")
+
+        try:
+            with (
+                zipfile.ZipFile(self.temp_path) as src,
+                zipfile.ZipFile(temp_path, "w") as dst,
+            ):
+                # 同じ名前のエントリは後のものが辞書に残る
+                latest = {info.filename: info for info in src.infolist()}
+                for info in latest.values():
+                    dst.writestr(info, src.read(info))
+            os.replace(temp_path, self.temp_path)
+        finally:
+            temp_path.unlink(True)
+
+
+def open_sink(output: str | Path) -> OutputSink:
+    output = Path(output)
+    if output.suffix.lower() == ".zip":
+        return ZipSink(output)
+    return FolderSink(output)
+
+
+class SharedSinks:
+    # 同じ出力先の OutputSink を使い終わるまで共有する
+    # 同じ書庫を別々に開くと、後から閉じた方が先に閉じた方の
+    # エントリを上書きしてしまう
+
+    def __init__(self) -> None:
+        self.sinks: dict[Path, tuple[OutputSink, int]] = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, output: str | Path) -> OutputSink:
+        key = Path(output).resolve()
+        with self.lock:
+            sink, count = self.sinks.get(key) or (open_sink(key), 0)
+            self.sinks[key] = sink, count + 1
+            return sink
+
+    def release(self, sink: OutputSink) -> None:
+        # 最後の利用者が手放したときに閉じる
+        with self.lock:
+            for key, (x, count) in self.sinks.items():
+                if x is sink:
+                    break
+            else:
+                return
+
+            if count > 1:
+                self.sinks[key] = sink, count - 1
+                return
+
+            del self.sinks[key]
+
+        sink.close()
+
+
+@contextmanager
+def sink_for(output: str | Path | OutputSink) -> Iterator[OutputSink]:
+    # 共有の OutputSink が渡された場合は閉じずにそのまま使う
+    if isinstance(output, OutputSink):
+        yield output
+    else:
+        with open_sink(output) as sink:
+            yield sink
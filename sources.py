@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import threading
+import zipfile
+from collections.abc import Iterator
+from functools import lru_cache
+from pathlib import Path
+from typing import IO
+
+from constants import ARCHIVE_SUFFIXES, IMAGE_SUFFIXES
+
+# 入力元の抽象化
+# 書庫内のファイルは "書庫のパス/エントリ名" という Path で表し、
+# 展開せずに直接読み出す
+
+
+def is_image(path: str | Path) -> bool:
+    return Path(path).suffix.lower() in IMAGE_SUFFIXES
+
+
+def is_archive(path: str | Path) -> bool:
+    return Path(path).suffix.lower() in ARCHIVE_SUFFIXES
+
+
+def iter_inputs(path: str | Path) -> Iterator[Path]:
+    path = Path(path)
+
+    if is_archive(path) and path.is_file():
+        archive = path.absolute()
+        for name in _index(archive, *_stat(archive)):
+            if is_image(name):
+                yield archive / name
+    elif is_image(path):
+        yield path
+
+
+def split_member(path: str | Path) -> tuple[Path, str] | None:
+    path = Path(path)
+
+    if path.is_file():
+        return None
+
+    for parent in path.parents:
+        if is_archive(parent) and parent.is_file():
+            return parent, path.relative_to(parent).as_posix()
+
+    return None
+
+
+def exists(path: str | Path) -> bool:
+    if (member := split_member(path)) is None:
+        return Path(path).is_file()
+
+    archive, name = member
+    return name in _index(archive, *_stat(archive))
+
+
+def stamp(path: str | Path) -> list[int] | None:
+    if (member := split_member(path)) is None:
+        try:
+            stat = Path(path).stat()
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    archive, name = member
+    if (info := _index(archive, *_stat(archive)).get(name)) is None:
+        return None
+    return [info.file_size, info.CRC]
+
+
+def open_input(path: str | Path) -> IO[bytes]:
+    if (member := split_member(path)) is None:
+        return open(path, "rb")
+
+    archive, name = member
+    return _open_member(archive, name)
+
+
+def read_bytes(path: str | Path) -> bytes:
+    if (member := split_member(path)) is None:
+        return Path(path).read_bytes()
+
+    archive, name = member
+    with _open_member(archive, name) as fp:
+        return fp.read()
+
+
+def close_archives() -> None:
+    # 書庫を開いたままだと Windows では移動や削除ができなくなる
+    # 読み出し中のエントリ (サムネイルの生成など) があれば、
+    # ファイルはそれを閉じたときに閉じられる
+    with _lock:
+        for archive in _archives.values():
+            archive.close()
+        _archives.clear()
+
+
+def _stat(archive: Path) -> tuple[int, int]:
+    stat = archive.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+@lru_cache(maxsize=16)
+def _index(
+    archive: Path,
+    mtime_ns: int,
+    size: int,
+) -> dict[str, zipfile.ZipInfo]:
+    # 更新日時とサイズをキーにするので書庫が変われば読み直される
+    with zipfile.ZipFile(archive) as zf:
+        return {
+            info.filename: info for info in zf.infolist() if not info.is_dir()
+        }
+
+
+_archives: dict[tuple[Path, int, int], zipfile.ZipFile] = {}
+_lock = threading.Lock()
+
+
+def _open_member(archive: Path, name: str) -> IO[bytes]:
+    # 中央ディレクトリの解析を毎回しないよう開いた書庫を使い回す
+    # ZipFile は複数スレッドから同時にエントリを読み出せる
+    # エントリを開くまでをロックの中で行い、close_archives() と競合して
+    # 閉じた書庫から読もうとしないようにする
+    # (開いたエントリは書庫を閉じても読み終えるまで使える)
+    key = archive, *_stat(archive)
+    with _lock:
+        if (zf := _archives.get(key)) is None:
+            zf = _archives[key] = zipfile.ZipFile(archive)
+        return zf.open(name)
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import builtins
+import sys
+import time
+from pathlib import Path
+
+# 起動時間の内訳を計測する (--profile-startup を指定したときだけ有効)
+# 以降の import を計測できるよう、app.py の最初で読み込むこと
+
+FLAG = "--profile-startup"
+TOP_IMPORTS = 20
+
+enabled = FLAG in sys.argv[1:]
+origin = time.perf_counter()
+marks: list[tuple[str, float]] = []
+imports: dict[str, float] = {}
+
+_import = builtins.__import__
+
+
+def _timed_import(
+    name: str,
+    globals: dict | None = None,
+    locals: dict | None = None,
+    fromlist: tuple = (),
+    level: int = 0,
+):
+    # 初めて読み込まれるモジュールだけ、依存先を含めた時間を記録する
+    if level or name in sys.modules:
+        return _import(name, globals, locals, fromlist, level)
+
+    start = time.perf_counter()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        imports.setdefault(name, time.perf_counter() - start)
+
+
+if enabled:
+    sys.argv.remove(FLAG)
+    builtins.__import__ = _timed_import
+
+
+def mark(name: str) -> None:
+    # 前回の mark からここまでを name の区間として記録する
+    if enabled:
+        marks.append((name, time.perf_counter()))
+
+
+def report() -> str:
+    lines = ["[phases]"]
+    last = origin
+    for name, at in marks:
+        lines.append(
+            f"{(at - last) * 1000:9.1f} ms  {name}"
+            f"  (+{(at - origin) * 1000:.1f} ms)"
+        )
+        last = at
+
+    lines.append("")
+    lines.append("[imports]")
+    for name, seconds in sorted(
+        imports.items(), key=lambda x: x[1], reverse=True
+    )[:TOP_IMPORTS]:
+        lines.append(f"{seconds * 1000:9.1f} ms  {name}")
+
+    return "\n".join(lines) + "\n"
+
+
+def finish(path: str | Path) -> None:
+    if not enabled:
+        return
+
+    builtins.__import__ = _import
+    text = report()
+    Path(path).write_text(text, encoding="utf-8")
+    if sys.stdout is not None:
+        print(text, end="")
@@ -0,0 +1,15 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# リポジトリ直下のモジュールをそのまま import する
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import capabilities  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def no_magick(monkeypatch: pytest.MonkeyPatch) -> None:
+    # ImageMagick を起動せず既定の機能で動かす
+    monkeypatch.setattr(capabilities, "_current", capabilities.Capabilities())
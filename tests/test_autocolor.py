@@ -0,0 +1,98 @@
+import math
+from collections import Counter
+from io import BytesIO
+
+import pytest
+
+import autocolor
+from image_header import read_size_from
+
+
+def pam(depth: int, pixels: list[bytes]) -> bytes:
+    header = (
+        f"P7\nWIDTH {len(pixels)}\nHEIGHT 1\nDEPTH {depth}\n"
+        f"MAXVAL 255\nTUPLTYPE RGB\nENDHDR\n"
+    )
+    return header.encode("ascii") + b"".join(pixels)
+
+
+def run_search(errors: dict[int, float], target: float, hint=None):
+    search = autocolor.search(target, hint)
+    tried = []
+    try:
+        colors = next(search)
+        while True:
+            tried.append(colors)
+            colors = search.send(errors[colors])
+    except StopIteration as e:
+        return e.value, tried
+
+
+# 色数に対して単調に減る誤差
+ERRORS = {n: 64 / n for n in autocolor.LEVELS}
+
+
+@pytest.mark.parametrize("target", [0.1, 0.25, 1, 2, 4, 8, 16, 32, 64])
+def test_search_finds_smallest_level(target):
+    expected = min(
+        (n for n in autocolor.LEVELS if ERRORS[n] <= target),
+        default=256,
+    )
+    colors, tried = run_search(ERRORS, target)
+    assert colors == expected
+    # 8段階の二分探索なので3回で決まる
+    assert len(tried) <= 3
+
+
+@pytest.mark.parametrize("hint", autocolor.LEVELS)
+def test_search_with_hint(hint):
+    colors, tried = run_search(ERRORS, 4, hint)
+    assert colors == 16
+    assert tried[0] == hint
+    # 外れても色数とその隣の2回が増えるだけ
+    assert len(tried) <= 2 + 3
+
+
+def test_search_checks_hint_and_neighbour_first():
+    # 前の倍率と同じ色数が答えなら2回で済む
+    colors, tried = run_search(ERRORS, 4, 16)
+    assert colors == 16
+    assert tried == [16, 8]
+
+
+def test_search_returns_256_when_target_unreachable():
+    colors, _ = run_search(ERRORS, 0.01)
+    assert colors == 256
+
+
+def test_histogram_and_palette_colors():
+    data = pam(3, [b"\0\0\0", b"\xff\xff\xff", b"\0\0\0"])
+    depth, histogram = autocolor.histogram(data)
+    assert depth == 3
+    assert histogram == Counter({b"\0\0\0": 2, b"\xff\xff\xff": 1})
+    assert autocolor.palette_colors(data) == (
+        3,
+        [b"\0\0\0", b"\xff\xff\xff", b"\0\0\0"],
+    )
+
+
+def test_read_pam_rejects_16bit():
+    data = b"P7\nWIDTH 1\nHEIGHT 1\nDEPTH 3\nMAXVAL 65535\nENDHDR\n"
+    with pytest.raises(ValueError):
+        autocolor.read_pam(data + b"\0" * 6)
+
+
+def test_error():
+    histogram = Counter({b"\0\0\0": 3, b"\x0c\x00\x00": 1})
+    assert autocolor.error(histogram, [b"\0\0\0", b"\x0c\x00\x00"]) == 0
+    # 1画素だけ距離 12 ずれる: sqrt(12^2 / 4) = 6
+    assert math.isclose(autocolor.error(histogram, [b"\0\0\0"]), 6)
+    assert autocolor.error(Counter(), [b"\0\0\0"]) == 0
+
+
+@pytest.mark.parametrize("depth", [1, 2, 3, 4])
+def test_encode_png(depth):
+    palette = [bytes([i] * depth) for i in range(5)]
+    data = autocolor.encode_png(depth, palette)
+    assert data.startswith(b"\x89PNG\r\n\x1a\n")
+    assert read_size_from(BytesIO(data)) == (5, 1)
@@ -0,0 +1,98 @@
+import struct
+from io import BytesIO
+
+import autocolor
+from image_header import read_frame_count, read_size_from, split_images
+
+
+def bmp(width: int, height: int, core: bool = False) -> bytes:
+    if core:
+        info = struct.pack("<IHHHH", 12, width, height, 1, 24)
+    else:
+        info = struct.pack("<IiiHH", 40, width, height, 1, 24) + bytes(24)
+    pixels = bytes(4)
+    size = 14 + len(info) + len(pixels)
+    return (
+        b"BM"
+        + struct.pack("<IHHI", size, 0, 0, 14 + len(info))
+        + info
+        + pixels
+    )
+
+
+def gif(frames: int, width: int = 3, height: int = 2) -> bytes:
+    # グローバルカラーテーブル (2色) 付きの GIF89a
+    data = b"GIF89a" + struct.pack("<HHBBB", width, height, 0x80, 0, 0)
+    data += bytes(6)
+    for _ in range(frames):
+        # 拡張ブロック (グラフィック制御) と画像ブロック
+        data += b"!\xf9\x04\x00\x00\x00\x00\x00"
+        data += b"," + struct.pack("<HHHHB", 0, 0, width, height, 0)
+        data += b"\x02\x02\x44\x01\x00"
+    return data + b";"
+
+
+def jpeg(width: int, height: int) -> bytes:
+    app0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\0" + bytes(9)
+    sof0 = b"\xff\xc0" + struct.pack(">HBHHB", 11, 8, height, width, 1)
+    sof0 += b"\x01\x11\x00"
+    sos = b"\xff\xda" + struct.pack(">HB", 8, 1) + b"\x01\x00\x00\x3f\x00"
+    # エントロピー符号化データの中の 0xFF 0x00 と RST
+    scan = b"\x12\xff\x00\x34\xff\xd0\x56"
+    return b"\xff\xd8" + app0 + sof0 + sos + scan + b"\xff\xd9"
+
+
+def test_read_size_png():
+    data = autocolor.encode_png(3, [b"\0\0\0"] * 7)
+    assert read_size_from(BytesIO(data)) == (7, 1)
+
+
+def test_read_size_gif():
+    assert read_size_from(BytesIO(gif(1, 320, 200))) == (320, 200)
+
+
+def test_read_size_bmp():
+    assert read_size_from(BytesIO(bmp(74, 94))) == (74, 94)
+    # 上下反転 (高さが負) と OS/2 形式
+    assert read_size_from(BytesIO(bmp(74, -94))) == (74, 94)
+    assert read_size_from(BytesIO(bmp(16, 8, core=True))) == (16, 8)
+
+
+def test_read_size_jpeg():
+    assert read_size_from(BytesIO(jpeg(632, 420))) == (632, 420)
+
+
+def test_read_size_unknown_or_broken():
+    assert read_size_from(BytesIO(b"not an image")) is None
+    assert read_size_from(BytesIO(b"\x89PNG\r\n\x1a\n")) is None
+    assert read_size_from(BytesIO(b"\xff\xd8\xff\xe0")) is None
+
+
+def test_read_frame_count():
+    assert read_frame_count(BytesIO(gif(1))) == 1
+    assert read_frame_count(BytesIO(gif(3))) == 3
+    assert read_frame_count(BytesIO(bmp(2, 2))) == 1
+    # 途中で切れていても数えられた分 (最低1)
+    assert read_frame_count(BytesIO(gif(3)[:20])) == 1
+
+
+def test_split_png():
+    images = [
+        autocolor.encode_png(3, [bytes([i] * 3)] * (i + 1)) for i in range(3)
+    ]
+    assert split_images(b"".join(images), "png") == images
+
+
+def test_split_bmp():
+    images = [bmp(1, 1), bmp(3, 2), bmp(2, 5)]
+    assert split_images(b"".join(images), "bmp") == images
+
+
+def test_split_jpeg():
+    images = [jpeg(1, 1), jpeg(2, 3)]
+    assert split_images(b"".join(images), "jpg") == images
+
+
+def test_split_unknown_keeps_everything():
+    assert split_images(b"abc", "gif") == [b"abc"]
+    assert split_images(b"", "png") == []
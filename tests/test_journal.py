@@ -0,0 +1,90 @@
+import os
+
+from journal import COMPACT_RATIO, BatchJournal
+
+
+def make(tmp_path):
+    source = tmp_path / "in.png"
+    source.write_bytes(b"input")
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    output = output_dir / "in.bmp"
+    output.write_bytes(b"output")
+    return source, output_dir, output
+
+
+def test_done_after_record(tmp_path):
+    source, output_dir, output = make(tmp_path)
+    root = tmp_path / "journals"
+
+    journal = BatchJournal(output_dir, {"quality": 1}, root)
+    assert not journal.is_done(source)
+    journal.record(source, [output])
+    assert journal.is_done(source)
+
+    # 読み直しても変換済み、設定が違えば未変換
+    assert BatchJournal(output_dir, {"quality": 1}, root).is_done(source)
+    assert not BatchJournal(output_dir, {"quality": 2}, root).is_done(source)
+    # 出力フォルダには何も書かない
+    assert list(output_dir.iterdir()) == [output]
+
+
+def test_changed_input_or_output_is_not_done(tmp_path):
+    source, output_dir, output = make(tmp_path)
+    root = tmp_path / "journals"
+    BatchJournal(output_dir, {}, root).record(source, [output])
+
+    output.write_bytes(b"edited output")
+    assert not BatchJournal(output_dir, {}, root).is_done(source)
+
+    BatchJournal(output_dir, {}, root).record(source, [output])
+    source.write_bytes(b"edited input")
+    assert not BatchJournal(output_dir, {}, root).is_done(source)
+
+
+def test_latest_record_wins_and_compacts(tmp_path):
+    source, output_dir, output = make(tmp_path)
+    root = tmp_path / "journals"
+
+    for quality in (1, 2, 1, 2, 1, 2):
+        BatchJournal(output_dir, {"quality": quality}, root).record(
+            source, [output]
+        )
+
+    # 最後に記録した設定だけが有効
+    assert BatchJournal(output_dir, {"quality": 2}, root).is_done(source)
+    assert not BatchJournal(output_dir, {"quality": 1}, root).is_done(source)
+
+    # 記録の数の COMPACT_RATIO 倍を超えないよう詰め直されている
+    (path,) = root.iterdir()
+    assert len(path.read_text("utf-8").splitlines()) <= COMPACT_RATIO
+
+
+def test_truncated_line_is_ignored(tmp_path):
+    source, output_dir, output = make(tmp_path)
+    root = tmp_path / "journals"
+    journal = BatchJournal(output_dir, {}, root)
+    journal.record(source, [output])
+
+    with open(journal.path, "a", encoding="utf-8") as fp:
+        fp.write('{"settings": "')
+
+    assert BatchJournal(output_dir, {}, root).is_done(source)
+
+
+def test_zip_output_is_not_journaled(tmp_path):
+    source, _, output = make(tmp_path)
+    root = tmp_path / "journals"
+    journal = BatchJournal(tmp_path / "out.zip", {}, root)
+    journal.record(source, [output])
+    assert not journal.is_done(source)
+    assert not root.exists()
+
+
+def test_separate_outputs_have_separate_journals(tmp_path):
+    source, output_dir, output = make(tmp_path)
+    root = tmp_path / "journals"
+    BatchJournal(output_dir, {}, root).record(source, [output])
+    other = tmp_path / "other"
+    os.mkdir(other)
+    assert not BatchJournal(other, {}, root).is_done(source)
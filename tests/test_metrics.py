@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from metrics import Registry
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter_prometheus(registry):
+    jobs = registry.counter("jobs_total", "ファイル数")
+    jobs.inc(status="done")
+    jobs.inc(2, status="done")
+    jobs.inc(status="failed")
+
+    assert registry.prometheus().splitlines() == [
+        "# HELP jobs_total ファイル数",
+        "# TYPE jobs_total counter",
+        'jobs_total{status="done"} 3',
+        'jobs_total{status="failed"} 1',
+    ]
+
+
+def test_same_name_returns_same_metric(registry):
+    assert registry.counter("a", "") is registry.counter("a", "")
+
+
+def test_labels_are_sorted_and_escaped(registry):
+    gauge = registry.gauge("depth", "待ち")
+    gauge.set(1.5, b="x", a='say "hi"\n')
+    gauge.dec(0.5, b="x", a='say "hi"\n')
+
+    assert registry.prometheus().splitlines()[-1] == (
+        'depth{a="say \\"hi\\"\\n",b="x"} 1'
+    )
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    seconds = registry.histogram("seconds", "時間", buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        seconds.observe(value, stage="render")
+
+    lines = registry.prometheus().splitlines()[2:]
+    assert lines == [
+        'seconds_bucket{stage="render",le="0.1"} 1',
+        'seconds_bucket{stage="render",le="1"} 3',
+        'seconds_bucket{stage="render",le="+Inf"} 4',
+        'seconds_sum{stage="render"} 6.05',
+        'seconds_count{stage="render"} 4',
+    ]
+
+
+def test_timer(registry):
+    seconds = registry.histogram("seconds", "")
+    with seconds.time(stage="x"):
+        pass
+    assert seconds.snapshot()[0]["count"] == 1
+
+
+def test_write_json_and_text(registry, tmp_path):
+    registry.counter("jobs_total", "").inc(status="done")
+
+    registry.write(tmp_path / "metrics.json")
+    data = json.loads((tmp_path / "metrics.json").read_text("utf-8"))
+    assert data["metrics"]["jobs_total"]["values"] == [
+        {"labels": {"status": "done"}, "value": 1}
+    ]
+
+    registry.write(tmp_path / "metrics.prom")
+    text = (tmp_path / "metrics.prom").read_text("utf-8")
+    assert 'jobs_total{status="done"} 1' in text
+    assert sorted(x.name for x in tmp_path.iterdir()) == [
+        "metrics.json",
+        "metrics.prom",
+    ]
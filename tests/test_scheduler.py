@@ -0,0 +1,124 @@
+import threading
+import time
+
+import pytest
+
+import autocolor
+from constants import ImageSize, ImageType, IndexedColor
+from scheduler import (
+    MemoryBudget,
+    apply_budget,
+    estimate_cost,
+    estimate_memory,
+    order_by_cost,
+)
+
+
+def png(path, width: int):
+    # 幅 width、高さ1の PNG
+    path.write_bytes(autocolor.encode_png(3, [b"\0\0\0"] * width))
+    return path
+
+
+def test_reserve_within_budget():
+    budget = MemoryBudget(100)
+    with budget.reserve(60) as limit:
+        assert limit == 0
+        assert budget.used == 60
+    assert budget.used == 0
+
+
+def test_reserve_over_budget_takes_everything_and_limits():
+    budget = MemoryBudget(100)
+    with budget.reserve(250) as limit:
+        assert limit == 100
+        assert budget.used == 100
+    assert budget.used == 0
+
+
+def test_reserve_waits_for_release():
+    budget = MemoryBudget(100)
+    admitted = threading.Event()
+
+    def second():
+        with budget.reserve(50):
+            admitted.set()
+
+    with budget.reserve(60):
+        thread = threading.Thread(target=second)
+        thread.start()
+        # 60 + 50 は予算を超えるので待たされる
+        assert not admitted.wait(0.1)
+
+    assert admitted.wait(5)
+    thread.join()
+    assert budget.used == 0
+
+
+def test_acquire_release():
+    budget = MemoryBudget(100)
+    reserved, limit = budget.acquire(40)
+    assert (reserved, limit, budget.used) == (40, 0, 40)
+    budget.release(reserved)
+    assert budget.used == 0
+
+
+def test_apply_budget(tmp_path):
+    paths = [png(tmp_path / "a.png", 10), png(tmp_path / "b.png", 20)]
+    options = {"image_type": ImageType.JPEG, "image_size": ImageSize.ASIS}
+
+    result = apply_budget(paths, options, 300)
+    assert result["jpeg_bytes_per_pixel"] == pytest.approx(300 / 30)
+    assert "jpeg_bytes_per_pixel" not in options
+
+    assert apply_budget(paths, options, 0) is options
+    png_options = {**options, "image_type": ImageType.PNG}
+    assert apply_budget(paths, png_options, 300) is png_options
+
+
+def test_apply_budget_counts_scaled_outputs(tmp_path):
+    paths = [png(tmp_path / "a.png", 10)]
+    options = {
+        "image_type": ImageType.JPEG,
+        "image_size": ImageSize.CARD,
+        "output_x2": True,
+    }
+    result = apply_budget(paths, options, 74 * 94 * 5)
+    # 等倍と2倍の出力の画素数の合計で割る
+    assert result["jpeg_bytes_per_pixel"] == pytest.approx(1)
+
+
+def test_order_by_cost(tmp_path):
+    small = png(tmp_path / "small.png", 10)
+    large = png(tmp_path / "large.png", 1000)
+    missing = tmp_path / "missing.png"
+    options = {"indexed_color": IndexedColor.INDEXED_8BIT}
+
+    assert order_by_cost([small, missing, large], options) == [
+        large,
+        small,
+        missing,
+    ]
+    assert estimate_cost(missing, options) == 0
+    assert estimate_cost(large, options) > estimate_cost(small, options)
+
+
+def test_estimate_memory(tmp_path):
+    path = png(tmp_path / "a.png", 100)
+    plain = estimate_memory(path, {})
+    indexed = estimate_memory(
+        path, {"indexed_color": IndexedColor.INDEXED_8BIT}
+    )
+    assert 0 < plain < indexed
+    assert estimate_memory(tmp_path / "missing.png", {}) == 0
+
+
+def test_reserve_releases_on_error():
+    budget = MemoryBudget(100)
+    with pytest.raises(RuntimeError):
+        with budget.reserve(80):
+            raise RuntimeError
+    started = time.monotonic()
+    with budget.reserve(80):
+        pass
+    assert time.monotonic() - started < 1
@@ -0,0 +1,94 @@
+import zipfile
+
+from sinks import FolderSink, SharedSinks, ZipSink, open_sink, sink_for
+
+
+def entries(path):
+    with zipfile.ZipFile(path) as zf:
+        return {info.filename: zf.read(info) for info in zf.infolist()}
+
+
+def test_folder_sink_replaces(tmp_path):
+    sink = FolderSink(tmp_path / "out")
+    sink.write("a.bmp", b"1")
+    path = sink.write("a.bmp", b"2")
+    assert path.read_bytes() == b"2"
+    assert [x.name for x in (tmp_path / "out").iterdir()] == ["a.bmp"]
+
+
+def test_zip_sink_last_write_wins(tmp_path):
+    archive = tmp_path / "out.zip"
+    with ZipSink(archive) as sink:
+        sink.write("a.bmp", b"1")
+        sink.write("b.png", b"b")
+        assert sink.write("a.bmp", b"2") == archive / "a.bmp"
+
+    assert entries(archive) == {"a.bmp": b"2", "b.png": b"b"}
+    assert [x.name for x in tmp_path.iterdir()] == ["out.zip"]
+
+
+def test_zip_sink_merges_existing_entries(tmp_path):
+    archive = tmp_path / "out.zip"
+    with ZipSink(archive) as sink:
+        sink.write("a.bmp", b"old a")
+        sink.write("b.bmp", b"old b")
+
+    with ZipSink(archive) as sink:
+        sink.write("a.bmp", b"new a")
+        sink.write("c.jpg", b"new c")
+
+    assert entries(archive) == {
+        "a.bmp": b"new a",
+        "c.jpg": b"new c",
+        "b.bmp": b"old b",
+    }
+
+
+def test_zip_sink_compresses_only_bmp(tmp_path):
+    archive = tmp_path / "out.zip"
+    with ZipSink(archive) as sink:
+        sink.write("a.bmp", bytes(1000))
+        sink.write("a.png", bytes(1000))
+
+    with zipfile.ZipFile(archive) as zf:
+        assert zf.getinfo("a.bmp").compress_type == zipfile.ZIP_DEFLATED
+        assert zf.getinfo("a.png").compress_type == zipfile.ZIP_STORED
+
+
+def test_open_sink(tmp_path):
+    assert isinstance(open_sink(tmp_path / "out"), FolderSink)
+    sink = open_sink(tmp_path / "out.ZIP")
+    assert isinstance(sink, ZipSink)
+    sink.close()
+
+
+def test_sink_for_does_not_close_shared_sink(tmp_path):
+    archive = tmp_path / "out.zip"
+    with ZipSink(archive) as shared:
+        with sink_for(shared) as sink:
+            sink.write("a.bmp", b"a")
+        with sink_for(shared) as sink:
+            sink.write("b.bmp", b"b")
+
+    assert entries(archive) == {"a.bmp": b"a", "b.bmp": b"b"}
+
+
+def test_shared_sinks_close_with_last_user(tmp_path):
+    archive = tmp_path / "out.zip"
+    sinks = SharedSinks()
+    first = sinks.acquire(archive)
+    second = sinks.acquire(tmp_path / "." / "out.zip")
+    assert first is second
+
+    first.write("a.bmp", b"a")
+    sinks.release(first)
+    assert not archive.exists()
+
+    second.write("b.bmp", b"b")
+    sinks.release(second)
+    assert entries(archive) == {"a.bmp": b"a", "b.bmp": b"b"}
+
+    # 閉じたあとは新しく開き直す
+    third = sinks.acquire(archive)
+    assert third is not first
+    sinks.release(third)
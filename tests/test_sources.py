@@ -0,0 +1,82 @@
+import zipfile
+from pathlib import Path
+
+import pytest
+
+import sources
+
+
+@pytest.fixture
+def archive(tmp_path):
+    path = tmp_path / "images.zip"
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("a.png", b"a")
+        zf.writestr("sub/b.bmp", b"b")
+        zf.writestr("readme.txt", b"text")
+        zf.writestr("empty/", b"")
+    yield path
+    sources.close_archives()
+
+
+def test_split_member(archive, tmp_path):
+    assert sources.split_member(archive / "a.png") == (archive, "a.png")
+    assert sources.split_member(archive / "sub" / "b.bmp") == (
+        archive,
+        "sub/b.bmp",
+    )
+    assert sources.split_member(archive) is None
+
+    plain = tmp_path / "plain.png"
+    plain.write_bytes(b"p")
+    assert sources.split_member(plain) is None
+    assert sources.split_member(tmp_path / "missing" / "x.png") is None
+
+
+def test_iter_inputs(archive, tmp_path):
+    assert list(sources.iter_inputs(archive)) == [
+        archive.absolute() / "a.png",
+        archive.absolute() / "sub/b.bmp",
+    ]
+    assert list(sources.iter_inputs(tmp_path / "x.PNG")) == [
+        tmp_path / "x.PNG"
+    ]
+    assert list(sources.iter_inputs(tmp_path / "x.txt")) == []
+
+
+def test_exists_stamp_and_read(archive):
+    member = archive / "sub" / "b.bmp"
+    assert sources.exists(member)
+    assert not sources.exists(archive / "missing.png")
+    assert sources.read_bytes(member) == b"b"
+    with sources.open_input(member) as fp:
+        assert fp.read() == b"b"
+
+    size, crc = sources.stamp(member)
+    assert size == 1 and crc == zipfile.crc32(b"b")
+    assert sources.stamp(archive / "missing.png") is None
+
+
+def test_rewritten_archive_is_read_again(archive):
+    assert sources.read_bytes(archive / "a.png") == b"a"
+
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("a.png", b"changed")
+
+    assert sources.read_bytes(archive / "a.png") == b"changed"
+    assert not sources.exists(archive / "sub" / "b.bmp")
+
+
+def test_open_member_survives_close_archives(archive):
+    fp = sources.open_input(archive / "a.png")
+    sources.close_archives()
+    assert fp.read() == b"a"
+    fp.close()
+
+
+def test_plain_file(tmp_path):
+    path = tmp_path / "a.png"
+    path.write_bytes(b"data")
+    assert sources.exists(path)
+    assert sources.read_bytes(path) == b"data"
+    assert sources.stamp(path)[0] == 4
+    assert not sources.exists(Path(tmp_path / "b.png"))
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from collections import deque
+from collections.abc import Callable
+from pathlib import Path
+
+import sources
+from converter import magick
+
+# 一度に生成待ちにしておく件数
+# 高速にスクロールした場合は古い (もう見えていない) 行から捨てる
+MAX_PENDING = 64
+
+
+# 入力一覧に表示するサムネイルのディスクキャッシュ
+# パス・サイズ・更新日時 (書庫内は CRC) をキーにし、
+# 上限を超えたら最後に使われたのが古いものから消す
+class ThumbnailCache:
+
+    def __init__(
+        self,
+        root: str | Path,
+        size: int,
+        capacity: int = 4096,
+        workers: int = 2,
+    ) -> None:
+        self.root = Path(root)
+        self.size = size
+        self.capacity = capacity
+        self.pending: deque[tuple[Path, Callable[[Path, Path], None]]] = deque(
+            maxlen=MAX_PENDING
+        )
+        self.requested: set[Path] = set()
+        self.count = -1
+        self.condition = threading.Condition()
+
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def key(self, path: str | Path) -> Path | None:
+        if (stamp := sources.stamp(path)) is None:
+            return None
+        text = "\0".join(map(str, (Path(path).absolute(), *stamp, self.size)))
+        name = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return self.root / name[:2] / f"{name}.png"
+
+    def request(
+        self,
+        path: str | Path,
+        callback: Callable[[Path, Path], None],
+    ) -> None:
+        # キャッシュにあるか生成できたらワーカスレッドから
+        # callback(入力のパス, サムネイルのパス) を呼ぶ
+        # 入力がネットワーク上にあってもよいよう、呼び出し元では
+        # ファイルの状態を調べない
+        path = Path(path)
+
+        with self.condition:
+            if path in self.requested:
+                return
+            if len(self.pending) == self.pending.maxlen:
+                self.requested.discard(self.pending[0][0])
+            self.pending.append((path, callback))
+            self.requested.add(path)
+            self.condition.notify()
+
+    def _work(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                # 新しく要求された (今見えている) 行から作る
+                path, callback = self.pending.pop()
+
+            try:
+                if (cache_path := self._get(path)) is not None:
+                    callback(path, cache_path)
+            except Exception:
+                # magick が見つからないなど、失敗してもその1件だけ諦めて
+                # ワーカは止めない (次に表示されたときにまた要求される)
+                pass
+            finally:
+                with self.condition:
+                    self.requested.discard(path)
+
+    def _get(self, path: Path) -> Path | None:
+        if (cache_path := self.key(path)) is None:
+            return None
+
+        try:
+            # 更新日時を最終使用日時として使う
+            os.utime(cache_path)
+        except OSError:
+            if not self._generate(path, cache_path):
+                return None
+
+        return cache_path
+
+    def _generate(self, path: Path, cache_path: Path) -> bool:
+        try:
+            data = sources.read_bytes(path)
+        except (OSError, KeyError):
+            return False
+
+        result = magick(
+            "-[0]",
+            "-thumbnail",
+            f"{self.size}x{self.size}>",
+            "-strip",
+            "PNG:-",
+            input=data,
+        )
+        if result.returncode != 0 or not result.stdout:
+            return False
+
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_name(f".{cache_path.name}.part")
+        try:
+            temp_path.write_bytes(result.stdout)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            return False
+        finally:
+            temp_path.unlink(True)
+
+        self._evict()
+        return True
+
+    def _evict(self) -> None:
+        with self.condition:
+            if self.count < 0:
+                self.count = sum(1 for _ in self.root.glob("*/*.png"))
+            else:
+                self.count += 1
+            if self.count <= self.capacity:
+                return
+            self.count = -1
+
+        # 毎回数え直さないよう上限の1割余分に消す
+        entries = []
+        for entry in self.root.glob("*/*.png"):
+            try:
+                entries.append((entry.stat().st_mtime_ns, entry))
+            except OSError:
+                pass
+
+        entries.sort()
+        for _, entry in entries[: len(entries) - self.capacity * 9 // 10]:
+            entry.unlink(True)
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from typing import Iterable
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Iterable, Protocol
 
 import wx
 import wx.lib.newevent
@@ -16,6 +18,44 @@ from .constants import (
 
 ClickEvent, EVT_CLICKED = wx.lib.newevent.NewCommandEvent()
 
+# (ラベル, 幅, 元のフォント) ごとの幅に収まるフォント
+_fitted_fonts: dict[tuple[str, int, str], wx.Font] = {}
+
+
+def fit_font(
+    window: wx.Window,
+    font: wx.Font,
+    label: str,
+    width: int,
+) -> wx.Font:
+    # 収まるまで1ピクセルずつ字幅を詰める (結果は使い回す)
+    key = label, width, font.GetNativeFontInfoDesc()
+
+    if (fitted := _fitted_fonts.get(key)) is not None:
+        return fitted
+
+    fitted = font
+    while True:
+        tw, th, *_ = window.GetFullTextExtent(label, fitted)
+        fw, fh = fitted.GetPixelSize()
+        fw = (fh if fw <= 0 else fw) - 1
+
+        if tw < width or fw <= 0:
+            break
+
+        fitted = wx.Font(
+            wx.Size(fw, fh),
+            font.GetFamily(),
+            font.GetStyle(),
+            font.GetWeight(),
+            font.GetUnderlined(),
+            font.GetFaceName(),
+            font.GetEncoding(),
+        )
+
+    _fitted_fonts[key] = fitted
+    return fitted
+
 
 class Label(wx.StaticText):
 
@@ -91,6 +131,8 @@ class Button(wx.Control):
         self.bg_colour = bg_colour
         self.hover_colour = hover_colour
         self.active_colour = active_colour
+        # 見た目の状態ごとに描いた画像 (大きさが変わったら描き直す)
+        self.bitmaps: dict[tuple, wx.Bitmap] = {}
 
         self.SetBackgroundStyle(wx.BG_STYLE_PAINT)
         self.SetBackgroundColour(bg_colour)
@@ -117,9 +159,40 @@ class Button(wx.Control):
     def _on_paint(self, event: wx.PaintEvent) -> None:
         self._update_colour()
 
-        dc = wx.BufferedPaintDC(self)
-        gc = wx.GraphicsContext.Create(dc)
+        dc = wx.PaintDC(self)
+        w, h = self.GetSize()
+        key = self._state_key()
+
+        if (bitmap := self.bitmaps.get(key)) is None:
+            if any(x[:2] != (w, h) for x in self.bitmaps):
+                self.bitmaps.clear()
+            bitmap = self.bitmaps[key] = self._render(w, h)
+
+        dc.DrawBitmap(bitmap, 0, 0)
+        event.Skip()
+
+    def _state_key(self) -> tuple:
+        # 描画結果を左右する値 (通常・ホバー・押下・無効などの状態)
         w, h = self.GetSize()
+        return (
+            w,
+            h,
+            self.label,
+            self.IsEnabled(),
+            self.is_active,
+            self.GetBackgroundColour().GetRGBA(),
+            self.GetForegroundColour().GetRGBA(),
+            self.GetParent().GetBackgroundColour().GetRGBA(),
+            self.GetFont().GetNativeFontInfoDesc(),
+        )
+
+    def _render(self, w: int, h: int) -> wx.Bitmap:
+        bitmap = wx.Bitmap(w, h)
+        dc = wx.MemoryDC(bitmap)
+        dc.SetFont(self.GetFont())
+        dc.SetTextForeground(self.GetForegroundColour())
+        dc.SetBackgroundMode(wx.TRANSPARENT)
+        gc = wx.GraphicsContext.Create(dc)
 
         self._draw_content(dc, gc, w, h)
 
@@ -130,7 +203,10 @@ class Button(wx.Control):
             gc.SetPen(wx.TRANSPARENT_PEN)
             gc.DrawRectangle(0, 0, w, h)
 
-        event.Skip()
+        # GraphicsContext の描画を確定させてから切り離す
+        del gc
+        dc.SelectObject(wx.NullBitmap)
+        return bitmap
 
     def _update_colour(self) -> None:
         mouse_screen = wx.GetMousePosition()
@@ -146,7 +222,7 @@ class Button(wx.Control):
 
     def _draw_content(
         self,
-        dc: wx.BufferedPaintDC,
+        dc: wx.DC,
         gc: wx.GraphicsContext,
         w: int,
         h: int,
@@ -162,27 +238,8 @@ class Button(wx.Control):
         gc.SetPen(wx.TRANSPARENT_PEN)
         gc.DrawRoundedRectangle(0, 0, w, h, r)
 
-        while True:
-            tw, th = dc.GetTextExtent(self.label)
-
-            if tw < w:
-                break
-
-            font = self.GetFont()
-            fw, fh = font.GetPixelSize()
-            fw = (fh if fw <= 0 else fw) - 1
-            font = wx.Font(
-                wx.Size(fw, fh),
-                font.GetFamily(),
-                font.GetStyle(),
-                font.GetWeight(),
-                font.GetUnderlined(),
-                font.GetFaceName(),
-                font.GetEncoding(),
-            )
-            self.SetFont(font)
-            dc.SetFont(font)
-
+        dc.SetFont(fit_font(self, self.GetFont(), self.label, w))
+        tw, th = dc.GetTextExtent(self.label)
         dc.DrawText(self.label, (w - tw) // 2, (h - th) // 2)
 
     def _on_enter(self, event: wx.MouseEvent) -> None:
@@ -424,7 +481,7 @@ class CheckBox(ToggleButton):
 
     def _draw_content(
         self,
-        dc: wx.BufferedPaintDC,
+        dc: wx.DC,
         gc: wx.GraphicsContext,
         w: int,
         h: int,
@@ -475,8 +532,17 @@ class CheckBox(ToggleButton):
             self._fire_click_event()
 
 
+class ThumbnailSource(Protocol):
+    def request(
+        self, path: Path, callback: Callable[[Path, Path], None]
+    ) -> None: ...
+
+
 class ListBox(wx.VListBox, wx.Control):
     items: tuple[str, ...]
+    thumbnail_size = SIZE_UNIT * 2
+    # 読み込み済みのサムネイルを保持しておく件数
+    bitmap_capacity = 256
 
     def __init__(
         self,
@@ -489,9 +555,27 @@ class ListBox(wx.VListBox, wx.Control):
 
         super().__init__(parent, style=style, *args, **kwargs)
 
+        self.thumbnails: ThumbnailSource | None = None
+        self.resolve: Callable[[str], Path | None] = lambda _: None
+        self.bitmaps: OrderedDict[Path, wx.Bitmap] = OrderedDict()
+        # 入力のパスごとのサムネイルのパス (ワーカスレッドから受け取る)
+        self.thumbnail_paths: dict[Path, Path] = {}
+
         self.SetItems(items)
         self.SetSelectionBackground(TOGGLE_COLOUR)
 
+    def SetThumbnails(
+        self,
+        thumbnails: ThumbnailSource,
+        resolve: Callable[[str], Path | None],
+    ) -> None:
+        # resolve は項目名から入力ファイルのパスを引く
+        self.thumbnails = thumbnails
+        self.resolve = resolve
+        self.thumbnail_paths.clear()
+        self.SetItemCount(len(self.items))
+        self.Refresh()
+
     def GetItems(self) -> tuple[str, ...]:
         return self.items
 
@@ -510,13 +594,66 @@ class ListBox(wx.VListBox, wx.Control):
         self.SetItems(())
 
     def OnMeasureItem(self, index) -> int:
-        return int(self.GetFont().GetPixelSize().GetHeight() * 1.2)
+        height = int(self.GetFont().GetPixelSize().GetHeight() * 1.2)
+        if self.thumbnails is not None:
+            height = max(height, self.thumbnail_size + SIZE_UNIT // 4)
+        return height
 
     def OnDrawItem(self, dc, rect, index) -> None:
         text = self.items[index]
         fw, fh = self.GetFont().GetPixelSize()
+        x = rect.x + fh // 5
+        y = rect.y + fh // 10
+
+        if self.thumbnails is not None:
+            # 描画される (見えている) 行の分だけ読み込みや生成を要求する
+            if bitmap := self._get_thumbnail(text):
+                dc.DrawBitmap(
+                    bitmap,
+                    x + (self.thumbnail_size - bitmap.GetWidth()) // 2,
+                    rect.y + (rect.height - bitmap.GetHeight()) // 2,
+                    True,
+                )
+            x += self.thumbnail_size + fh // 2
+            y = rect.y + (rect.height - fh) // 2
+
         dc.SetTextForeground(wx.Colour(33, 33, 33))
-        dc.DrawText(text, rect.x + fh // 5, rect.y + fh // 10)
+        dc.DrawText(text, x, y)
+
+    def _get_thumbnail(self, item: str) -> wx.Bitmap | None:
+        if self.thumbnails is None or (path := self.resolve(item)) is None:
+            return None
+
+        # 描画のたびに入力のファイルを調べないよう、キャッシュの確認や
+        # 生成はワーカスレッドに任せて結果のパスを覚えておく
+        if (cache_path := self.thumbnail_paths.get(path)) is None:
+            self.thumbnails.request(
+                path,
+                lambda *args: wx.CallAfter(self._on_thumbnail, *args),
+            )
+            return None
+
+        if (bitmap := self.bitmaps.get(cache_path)) is not None:
+            self.bitmaps.move_to_end(cache_path)
+            return bitmap
+
+        bitmap = wx.Bitmap(str(cache_path), wx.BITMAP_TYPE_PNG)
+        if not bitmap.IsOk():
+            # キャッシュから消されていたら作り直す
+            if not cache_path.exists():
+                del self.thumbnail_paths[path]
+            return None
+
+        self.bitmaps[cache_path] = bitmap
+        if len(self.bitmaps) > self.bitmap_capacity:
+            self.bitmaps.popitem(last=False)
+        return bitmap
+
+    def _on_thumbnail(self, path: Path, cache_path: Path) -> None:
+        # ワーカスレッドで生成し終えるまでに閉じられている場合がある
+        if self:
+            self.thumbnail_paths[path] = cache_path
+            self.Refresh()
 
     def OnDrawBackground(self, dc, rect, index) -> None:
         if self.IsSelected(index):
@@ -28,7 +28,7 @@ class MainFrame(wx.Frame):
         super().__init__(
             None,
             title=cs.WINDOW_TITLE,
-            size=wx.Size(SIZE_UNIT * 40, SIZE_UNIT * 28),
+            size=wx.Size(SIZE_UNIT * 40, SIZE_UNIT * 39),
             style=wx.CAPTION | wx.CLOSE_BOX | wx.MINIMIZE_BOX,
         )
 
@@ -178,7 +178,10 @@ class OutputDirBlock(BlockSizer):
 
         self.Add(sizer, 0, wx.EXPAND)
 
-        self.controls = (*buttons,)
+        self.zip_checkbox = CheckBox(parent, cs.OUTPUT_ZIP_LABEL)
+        self.Add(self.zip_checkbox, 0, wx.TOP, SIZE_UNIT // 5)
+
+        self.controls = (*buttons, self.zip_checkbox)
 
 
 class OutputSizeBlock(BlockSizer):
@@ -221,10 +224,29 @@ class OutputFormatBlock(BlockSizer):
         self.outline_style_choice = wx.Choice(
             parent, choices=list[str](cs.OutlineStyle)
         )
+        self.outline_width_choice = wx.Choice(
+            parent, choices=[f"{x}px" for x in cs.OUTLINE_WIDTHS]
+        )
+        self.dither_method_choice = wx.Choice(
+            parent, choices=list[str](cs.DitherMethod)
+        )
+        self.animation_mode_choice = wx.Choice(
+            parent, choices=list[str](cs.AnimationMode)
+        )
+        self.quality_choice = wx.Choice(parent, choices=list[str](cs.Quality))
+        self.jpeg_max_size_choice = wx.Choice(
+            parent,
+            choices=[cs.jpeg_max_size_label(x) for x in cs.JPEG_MAX_SIZES],
+        )
 
         for label, control in (
             (cs.INDEXED_COLOR_LABEL, self.indexed_color_choice),
+            (cs.DITHER_METHOD_LABEL, self.dither_method_choice),
             (cs.OUTLINE_STYLE_LABEL, self.outline_style_choice),
+            (cs.OUTLINE_WIDTH_LABEL, self.outline_width_choice),
+            (cs.ANIMATION_MODE_LABEL, self.animation_mode_choice),
+            (cs.QUALITY_LABEL, self.quality_choice),
+            (cs.JPEG_MAX_SIZE_LABEL, self.jpeg_max_size_choice),
         ):
             sizer = wx.BoxSizer()
             control.SetSelection(0)
@@ -241,5 +263,10 @@ class OutputFormatBlock(BlockSizer):
             self.switch,
             self.color_mask_checkbox,
             self.indexed_color_choice,
+            self.dither_method_choice,
             self.outline_style_choice,
+            self.outline_width_choice,
+            self.animation_mode_choice,
+            self.quality_choice,
+            self.jpeg_max_size_choice,
         )
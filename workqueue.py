@@ -0,0 +1,352 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any
+
+from converter_params import ConverterParams
+
+# 共有フォルダを介した複数マシンでの分散変換
+#
+#   queue/settings.json       全ジョブ共通の設定 (config.json と同じ形式)
+#   queue/pending/<id>.json   未着手のジョブ
+#   queue/claimed/<id>@<worker>.json
+#                             実行中のジョブ (更新日時がハートビート)
+#   queue/done/<id>.json      完了したジョブと出力
+#   queue/failed/<id>.json    失敗したジョブ
+#   queue/workers/<worker>.json
+#                             ワーカごとの状態 (更新日時がハートビート)
+#
+# ジョブの取得や返却は同じファイルシステム上の rename で行うので、
+# 同じジョブを複数のワーカが取ることはない。
+# ハートビートが途絶えたジョブは他のワーカが pending に戻して取り直す。
+
+SETTINGS_NAME = "settings.json"
+STATES = ("pending", "claimed", "done", "failed")
+
+
+class WorkQueue:
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = Path(root)
+        self.dirs = {state: self.root / state for state in STATES}
+        self.workers_dir = self.root / "workers"
+
+    def create(self) -> None:
+        for path in (*self.dirs.values(), self.workers_dir):
+            path.mkdir(parents=True, exist_ok=True)
+
+    def submit(self, params: ConverterParams) -> int:
+        # 重いジョブから取られるよう推定コスト順の番号を ID の先頭に付ける
+        from scheduler import apply_budget, order_by_cost
+
+        if params.output_dir.suffix.lower() == ".zip":
+            raise ValueError("ZIP output cannot be shared between workers")
+
+        self.create()
+        settings_path = self.root / SETTINGS_NAME
+        temp_path = settings_path.with_name(f".{SETTINGS_NAME}.part")
+        try:
+            params.save(temp_path)
+            os.replace(temp_path, settings_path)
+        finally:
+            temp_path.unlink(True)
+
+        inputs = tuple(params.input_files.values())
+        options = params.options()
+        paths = order_by_cost(inputs, options)
+
+        # バッチ全体で決まる設定 (JPEG の出力サイズの予算) はジョブに持たせる
+        budget = apply_budget(inputs, options, params.jpeg_budget)
+        extra = {k: v for k, v in budget.items() if k not in options}
+
+        for rank, path in enumerate(paths):
+            digest = hashlib.sha1(str(path).encode("utf-8")).hexdigest()
+            job_id = f"{rank:06}-{digest[:12]}"
+            job = {"id": job_id, "input": str(path), "attempts": 0}
+            if extra:
+                job["options"] = extra
+            _write_json(self.dirs["pending"] / f"{job_id}.json", job)
+
+        return len(paths)
+
+    def settings(self) -> ConverterParams:
+        params = ConverterParams()
+        params.load(self.root / SETTINGS_NAME)
+        return params
+
+    def counts(self) -> dict[str, int]:
+        return {
+            state: sum(1 for _ in path.glob("*.json"))
+            for state, path in self.dirs.items()
+        }
+
+
+class Worker:
+
+    def __init__(
+        self,
+        queue: WorkQueue,
+        worker_id: str | None = None,
+        jobs: int = 0,
+        heartbeat: float = 10,
+        stale: float = 60,
+        max_attempts: int = 3,
+    ) -> None:
+
+        self.queue = queue
+        if not worker_id:
+            worker_id = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.id = worker_id
+        self.jobs = jobs
+        self.heartbeat = heartbeat
+        self.stale = stale
+        self.max_attempts = max_attempts
+        self.status_path = queue.workers_dir / f"{self.id}.json"
+        self.claimed: set[Path] = set()
+        self.stats = {"done": 0, "failed": 0}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run(self, wait: bool = False) -> None:
+        # wait が偽なら未着手のジョブがなくなった時点で終わる
+        from concurrent.futures import ThreadPoolExecutor
+
+        from scheduler import default_workers, thread_limit
+
+        self.queue.create()
+        params = self.queue.settings()
+        options = params.options()
+        limits = params.job_limits()
+        workers = self.jobs or default_workers()
+        options["thread_limit"] = thread_limit(workers)
+        options["palette_cache"] = True
+
+        beat = threading.Thread(target=self._beat, daemon=True)
+        beat.start()
+
+        def work() -> None:
+            while not self.stopped.is_set():
+                if (job := self.claim()) is None:
+                    if not wait and not self._others_running():
+                        return
+                    time.sleep(self.heartbeat / 2)
+                    continue
+                self._run(job, params.output_dir, limits, options)
+
+        try:
+            with ThreadPoolExecutor(workers) as executor:
+                for _ in range(workers):
+                    executor.submit(work)
+        finally:
+            self.stopped.set()
+            beat.join()
+            self.status_path.unlink(True)
+
+    def claim(self) -> dict[str, Any] | None:
+        self.reclaim()
+
+        for pending in sorted(self.queue.dirs["pending"].glob("*.json")):
+            claimed = self.queue.dirs["claimed"] / (
+                f"{pending.stem}@{self.id}.json"
+            )
+            try:
+                os.rename(pending, claimed)
+                # rename では更新日時が変わらないので取った時点を記録する
+                os.utime(claimed)
+            except OSError:
+                # 他のワーカが先に取った
+                continue
+
+            with self.lock:
+                self.claimed.add(claimed)
+
+            job = _read_json(claimed) or {"id": pending.stem}
+            job["attempts"] = job.get("attempts", 0) + 1
+
+            # ワーカごと落ちても回数が残るよう、実行する前に書き戻す
+            try:
+                _write_json(claimed, job)
+            except OSError:
+                pass
+
+            if job["attempts"] > self.max_attempts:
+                # 実行中にワーカごと落ちるジョブを取り直し続けないようにする
+                job["error"] = "ワーカが応答しなくなりました"
+                self._finish(claimed, job, "failed")
+                continue
+
+            job["path"] = claimed
+            return job
+
+        return None
+
+    def reclaim(self) -> None:
+        # 時刻のずれに左右されないよう、ファイルサーバの時刻
+        # (自分のハートビートの更新日時) と比べる
+        try:
+            now = self.status_path.stat().st_mtime
+        except OSError:
+            return
+
+        for claimed in self.queue.dirs["claimed"].glob("*.json"):
+            try:
+                if now - claimed.stat().st_mtime < self.stale:
+                    continue
+                job_id = claimed.stem.partition("@")[0]
+                pending = self.queue.dirs["pending"] / f"{job_id}.json"
+                os.rename(claimed, pending)
+            except OSError:
+                continue
+
+    def _run(
+        self,
+        job: dict[str, Any],
+        output_dir: Path,
+        limits: dict[str, Any],
+        options: dict[str, Any],
+    ) -> None:
+        from converter import FallbackWarning, convert
+        from report import describe
+
+        claimed: Path = job.pop("path")
+        started = time.perf_counter()
+
+        try:
+            outputs = convert(
+                job["input"],
+                output_dir,
+                **limits,
+                **{**options, **job.get("options", {})},
+            )
+        except FallbackWarning as e:
+            # やり直しても同じ結果になるので出力を残して終える
+            job["outputs"] = [str(x) for x in e.outputs]
+            job["warning"] = describe(e)
+            state = "done"
+        except Exception as e:
+            job["error"] = describe(e)
+            state = "failed"
+            if job["attempts"] < self.max_attempts:
+                state = "pending"
+        else:
+            job["outputs"] = [str(x) for x in outputs]
+            state = "done"
+
+        job["worker"] = self.id
+        job["seconds"] = round(time.perf_counter() - started, 3)
+        self._finish(claimed, job, state)
+
+    def _finish(self, claimed: Path, job: dict[str, Any], state: str) -> None:
+        with self.lock:
+            self.claimed.discard(claimed)
+            if state != "pending":
+                self.stats[state] += 1
+
+        # 取り直されていた場合は取り直した側に任せる
+        if not claimed.exists():
+            return
+
+        # 内容を書き換えてから rename で次の状態へ移す
+        try:
+            _write_json(claimed, job)
+            os.replace(claimed, self.queue.dirs[state] / f"{job['id']}.json")
+        except OSError:
+            pass
+
+    def _beat(self) -> None:
+        while True:
+            with self.lock:
+                claimed = tuple(self.claimed)
+                status = {
+                    "worker": self.id,
+                    "pid": os.getpid(),
+                    "claimed": [x.name for x in claimed],
+                    **self.stats,
+                }
+
+            for path in claimed:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+
+            try:
+                _write_json(self.status_path, status)
+            except OSError:
+                pass
+
+            if self.stopped.wait(self.heartbeat):
+                return
+
+    def _others_running(self) -> bool:
+        # 他のワーカが実行中のジョブが失敗して戻ってくる場合に備える
+        return any(
+            not path.stem.endswith(f"@{self.id}")
+            for path in self.queue.dirs["claimed"].glob("*.json")
+        )
+
+
+def _read_json(path: Path) -> dict[str, Any] | None:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _write_json(path: Path, data: Any) -> None:
+    # 書きかけを他のワーカが読まないよう置き換える
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}.part")
+    try:
+        temp_path.write_text(
+            json.dumps(data, ensure_ascii=False, indent=4), encoding="utf-8"
+        )
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(True)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="WirthMage --queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit = commands.add_parser("submit")
+    submit.add_argument("queue", type=Path)
+    submit.add_argument("config", type=Path)
+
+    work = commands.add_parser("work")
+    work.add_argument("queue", type=Path)
+    work.add_argument("--id", default=None)
+    work.add_argument("--jobs", type=int, default=0)
+    work.add_argument("--heartbeat", type=float, default=10)
+    work.add_argument("--stale", type=float, default=60)
+    work.add_argument("--wait", action="store_true")
+
+    status = commands.add_parser("status")
+    status.add_argument("queue", type=Path)
+
+    args = parser.parse_args(argv)
+    queue = WorkQueue(args.queue)
+
+    if args.command == "submit":
+        params = ConverterParams()
+        params.load(args.config)
+        print(queue.submit(params))
+
+    elif args.command == "work":
+        worker = Worker(queue, args.id, args.jobs, args.heartbeat, args.stale)
+        worker.run(args.wait)
+
+    print(json.dumps(queue.counts()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from converter_params import ConverterParams
+from workqueue import WorkQueue, Worker
+
+# 共有フォルダのワークキューを1台のマシン上で試すハーネス
+#
+#   python workqueue_harness.py [--workers 4] [--jobs 60] [--kill 5]
+#
+# 一時フォルダにキューを作り、ワーカを別プロセスで複数起動して、
+# 実行中のワーカを強制終了しては起動し直す。変換は ImageMagick を使わない
+# 偽物に差し替え、入力名に "poison" を含むジョブは実行したワーカごと落とす。
+# すべて終わったら、毒入り以外のジョブが完了して出力があること、
+# 毒入りのジョブが試行回数の上限で失敗になっていることを確かめる。
+
+POISON = "poison"
+RUNS_NAME = "runs.log"
+
+
+def fake_convert(path: str | Path, output_dir: str | Path, **_) -> list[Path]:
+    path = Path(path)
+    runs = Path(output_dir).parent / RUNS_NAME
+
+    # 何回実行されたかを数えるため、追記で1行ずつ残す
+    with open(runs, "a", encoding="utf-8") as fp:
+        fp.write(f"{path.name}\n")
+
+    if POISON in path.name:
+        os._exit(1)
+
+    time.sleep(random.uniform(0.05, 0.3))
+    output_path = Path(output_dir) / path.with_suffix(".bmp").name
+    output_path.write_bytes(path.read_bytes())
+    return [output_path]
+
+
+def run_worker(
+    root: Path,
+    jobs: int,
+    heartbeat: float,
+    stale: float,
+    max_attempts: int,
+) -> None:
+    import converter
+
+    converter.convert = fake_convert
+    worker = Worker(
+        WorkQueue(root),
+        jobs=jobs,
+        heartbeat=heartbeat,
+        stale=stale,
+        max_attempts=max_attempts,
+    )
+    worker.run()
+
+
+def submit(root: Path, count: int, poison: int) -> list[Path]:
+    input_dir = root.parent / "input"
+    output_dir = root.parent / "output"
+    input_dir.mkdir(parents=True)
+    output_dir.mkdir(parents=True)
+
+    params = ConverterParams()
+    params.output_dir = output_dir
+    for i in range(count):
+        kind = POISON if i < poison else "image"
+        path = input_dir / f"{kind}-{i:04}.png"
+        path.write_bytes(os.urandom(random.randrange(64, 4096)))
+        params.input_files[path.name] = path
+
+    WorkQueue(root).submit(params)
+    return list(params.input_files.values())
+
+
+def simulate(
+    workers: int = 4,
+    jobs: int = 60,
+    kill: int = 5,
+    poison: int = 1,
+    threads: int = 2,
+    heartbeat: float = 0.2,
+    stale: float = 1.0,
+    max_attempts: int = 3,
+    timeout: float = 120,
+) -> bool:
+    context = multiprocessing.get_context("spawn")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir) / "queue"
+        inputs = submit(root, jobs, poison)
+        queue = WorkQueue(root)
+        args = (root, threads, heartbeat, stale, max_attempts)
+        processes: list[multiprocessing.process.BaseProcess] = []
+        started = time.perf_counter()
+        killed = 0
+
+        while time.perf_counter() - started < timeout:
+            processes = [x for x in processes if x.is_alive()]
+            counts = queue.counts()
+            if not counts["pending"] and not counts["claimed"]:
+                break
+
+            # 落ちたり終わったりした分を起動し直す
+            while len(processes) < workers:
+                process = context.Process(target=run_worker, args=args)
+                process.start()
+                processes.append(process)
+
+            # ジョブを取って実行中のワーカを1回に1つ強制終了する
+            busy = [x for x in processes if _has_claims(root, x.pid)]
+            if killed < kill and busy:
+                random.choice(busy).kill()
+                killed += 1
+
+            time.sleep(heartbeat)
+
+        for process in processes:
+            process.join(timeout)
+        seconds = time.perf_counter() - started
+
+        return _verify(root, inputs, killed, max_attempts, seconds)
+
+
+def _has_claims(root: Path, pid: int | None) -> bool:
+    for path in (root / "workers").glob("*.json"):
+        try:
+            status = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        if status.get("pid") == pid and status.get("claimed"):
+            return True
+    return False
+
+
+def _verify(
+    root: Path,
+    inputs: list[Path],
+    killed: int,
+    max_attempts: int,
+    seconds: float,
+) -> bool:
+    queue = WorkQueue(root)
+    output_dir = root.parent / "output"
+    runs = Counter((root.parent / RUNS_NAME).read_text().split())
+    done = {path.stem for path in queue.dirs["done"].glob("*.json")}
+    failed = {path.stem for path in queue.dirs["failed"].glob("*.json")}
+    errors = []
+
+    counts = queue.counts()
+    if counts["pending"] or counts["claimed"]:
+        errors.append(f"終わらなかったジョブがある: {counts}")
+
+    states = {}
+    for state in ("done", "failed"):
+        for path in queue.dirs[state].glob("*.json"):
+            job = json.loads(path.read_text(encoding="utf-8"))
+            states[Path(job["input"]).name] = state
+
+    for path in inputs:
+        state = states.get(path.name, "missing")
+        if state == "failed":
+            # 毒入りのジョブか、実行中のワーカが上限の回数だけ
+            # 強制終了されたジョブ
+            if runs[path.name] != max_attempts:
+                errors.append(
+                    f"{path.name}: {runs[path.name]}回実行されて失敗"
+                    f" (上限 {max_attempts}回)"
+                )
+        elif POISON in path.name:
+            errors.append(f"{path.name}: 失敗になっていない ({state})")
+        elif state != "done":
+            errors.append(f"{path.name}: 完了していない ({state})")
+        elif not (output_dir / path.with_suffix(".bmp").name).is_file():
+            errors.append(f"{path.name}: 出力がない")
+
+    # 強制終了したワーカが実行中だった分だけ実行し直される
+    reruns = sum(n - 1 for name, n in runs.items() if POISON not in name)
+
+    print(
+        f"{len(done)} done, {len(failed)} failed,"
+        f" {killed} workers killed, {reruns} reruns ({seconds:.1f}s)"
+    )
+    for error in errors:
+        print(f"NG {error}")
+
+    return not errors
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="workqueue_harness.py")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=60)
+    parser.add_argument("--kill", type=int, default=5)
+    parser.add_argument("--poison", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=2)
+    parser.add_argument("--heartbeat", type=float, default=0.2)
+    parser.add_argument("--stale", type=float, default=1.0)
+    parser.add_argument("--max-attempts", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args(argv)
+
+    ok = simulate(
+        args.workers,
+        args.jobs,
+        args.kill,
+        args.poison,
+        args.threads,
+        args.heartbeat,
+        args.stale,
+        args.max_attempts,
+        args.timeout,
+    )
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()